@@ -0,0 +1,199 @@
+# Benchmarks for the rate lookups and data pipeline in models.py
+#
+# Run from the repository root (models look for data in ./datasets), e.g.
+#   python benchmarks.py threads --oil_type chichimene --experiment "0 PSI"
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from models import NonArrheniusML, find_start_end, find_start_end_batch
+
+
+def time_call(func, repeats = 3):
+    '''
+    Best wall time in seconds of func() over repeats calls
+    '''
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark_threads(args):
+    '''
+    Speedup of NonArrheniusML.get_rate_and_var on a surface plot grid against number of threads
+    '''
+
+    model = NonArrheniusML(oil_type=args.oil_type, experiment=args.experiment, interpnum=args.interpnum)
+    Tgrid, O2grid = np.mgrid[20:750:args.grid*1j, 0:1:args.grid*1j]
+
+    max_threads = args.max_threads if args.max_threads is not None else os.cpu_count()
+    thread_counts = sorted(set([1] + [2**i for i in range(int(np.log2(max_threads)) + 1)] + [max_threads]))
+
+    print('Training points M={}, query points N={}'.format(model.Temps.size, Tgrid.size))
+    print('{:>8} {:>10} {:>8}'.format('threads', 'time [s]', 'speedup'))
+
+    base_rates, base_time = None, None
+    for n in thread_counts:
+        rates, _ = model.get_rate_and_var(Tgrid, O2grid, n_threads=n)
+        t = time_call(lambda: model.get_rate_and_var(Tgrid, O2grid, n_threads=n), repeats=args.repeats)
+        if base_rates is None:
+            base_rates, base_time = rates, t
+        elif not np.array_equal(rates, base_rates):
+            raise Exception('Rates with {} threads differ from single-threaded rates.'.format(n))
+        print('{:>8} {:>10.3f} {:>8.2f}'.format(n, t, base_time / t))
+
+
+def reference_scalar_rate(model, T, O2conv):
+    '''
+    Scalar rate lookup as NonArrheniusML did it before the design matrix was prepared once: the 
+        normalized design matrix, targets and weights are rebuilt on every call
+    '''
+    T_norm = T / np.amax(model.Temps)
+    Temps_norm = model.Temps / np.amax(model.Temps)
+    xq = np.expand_dims(np.array([T_norm, O2conv, 1.0]),0)
+    X = np.column_stack([Temps_norm.flatten(), model.O2convs.flatten(), np.ones_like(model.O2convs.flatten())])
+    y = model.dXdt.flatten()
+    W = np.exp(-np.sum((X - xq)**2, axis=1, keepdims=True) / model.tau**2 / 2)
+    XTW = np.transpose(X*W)
+    L = np.dot(np.squeeze(xq), np.linalg.solve(np.matmul(XTW, X), XTW))
+    return max(np.dot(L, y), 0) if model.constrained else np.dot(L, y)
+
+
+def benchmark_scalar(args):
+    '''
+    Per-call latency of scalar NonArrheniusML.conversion_lookup, as called by ODE right-hand sides
+    '''
+
+    model = NonArrheniusML(oil_type=args.oil_type, experiment=args.experiment, interpnum=args.interpnum)
+    rng = np.random.default_rng(0)
+    queries = np.column_stack([rng.uniform(20, 750, args.calls), rng.uniform(0, 1, args.calls)])
+
+    def run(lookup):
+        return lambda: [lookup(T, X) for T, X in queries]
+
+    before = time_call(run(lambda T, X: reference_scalar_rate(model, T, X)), repeats=args.repeats)
+    after = time_call(run(model.conversion_lookup), repeats=args.repeats)
+
+    print('Training points M={}, {} scalar calls'.format(model.Temps.size, args.calls))
+    print('{:>8} {:>14}'.format('', 'latency [us]'))
+    print('{:>8} {:>14.1f}'.format('before', 1e6*before/args.calls))
+    print('{:>8} {:>14.1f}'.format('after', 1e6*after/args.calls))
+
+
+def benchmark_cutoff(args):
+    '''
+    Time of NonArrheniusML.evaluate_kernel at the training points against the kernel cutoff, as
+        used by estimate_sigma
+    '''
+
+    model = NonArrheniusML(oil_type=args.oil_type, experiment=args.experiment, interpnum=args.interpnum)
+    tau = args.tau if args.tau is not None else model.tau
+    xq = np.column_stack([model.design.T, np.ones(model.y.shape[0])])
+
+    print('Training points M={}, tau={}'.format(model.y.shape[0], tau))
+    print('{:>8} {:>10} {:>8} {:>10} {:>12}'.format('cutoff', 'time [s]', 'speedup', 'fallback', 'max rel diff'))
+
+    base_rates, base_time = None, None
+    for cutoff in [None] + args.cutoffs:
+        model.cutoff = cutoff
+        rates = model.evaluate_kernel(xq, tau)[0]
+        t = time_call(lambda: model.evaluate_kernel(xq, tau), repeats=args.repeats)
+        if cutoff is None:
+            base_rates, base_time, fallback = rates, t, 0.0
+        else:
+            fallback = np.mean(model.truncated_rate_and_var(xq, tau, False, return_moments=True)[4])
+        print('{:>8} {:>10.3f} {:>8.2f} {:>10.2f} {:>12.1e}'.format(str(cutoff), t, base_time / t, fallback,
+              np.amax(np.abs(rates - base_rates)) / np.amax(np.abs(base_rates))))
+
+
+def reference_find_start_end(x):
+    '''
+    find_start_end as it was before vectorization: a sequential scan in Python
+    '''
+    start_ind = 0
+    end_ind = 0
+    start_ind_max = 0
+    end_ind_max = x.shape[0]
+    cumsum = 0.0
+    max_cumsum = 0.0
+    for i in range(x.shape[0]):
+        if x[i] <= 0:
+            if cumsum > max_cumsum:
+                max_cumsum = cumsum
+                start_ind_max = start_ind
+                end_ind_max = end_ind
+            cumsum = 0.0
+            start_ind = i
+            end_ind = i
+        else:
+            cumsum += x[i]
+            end_ind += 1
+    return start_ind_max, end_ind_max
+
+
+def synthetic_consumption(n, rng):
+    '''
+    Noisy O2 consumption trace of n samples: a consumption peak on a baseline clipped at zero
+    '''
+    t = np.linspace(0, 1, n)
+    return np.maximum(5*np.exp(-((t - 0.5)/0.1)**2) + rng.normal(0, 0.2, n), 0)
+
+
+def benchmark_find_start_end(args):
+    '''
+    Vectorized find_start_end and find_start_end_batch against the sequential Python scan
+    '''
+
+    rng = np.random.default_rng(0)
+    series = [synthetic_consumption(args.samples, rng) for _ in range(args.series)]
+
+    reference = [reference_find_start_end(x) for x in series]
+    if [find_start_end(x) for x in series] != reference or find_start_end_batch(series) != reference:
+        raise Exception('Vectorized indices differ from the sequential scan.')
+
+    loop = time_call(lambda: [reference_find_start_end(x) for x in series], repeats=args.repeats)
+    single = time_call(lambda: [find_start_end(x) for x in series], repeats=args.repeats)
+    batch = time_call(lambda: find_start_end_batch(series), repeats=args.repeats)
+
+    print('{} series of {} samples'.format(args.series, args.samples))
+    print('{:>10} {:>10} {:>8}'.format('', 'time [s]', 'speedup'))
+    print('{:>10} {:>10.4f} {:>8.1f}'.format('loop', loop, 1.0))
+    print('{:>10} {:>10.4f} {:>8.1f}'.format('single', single, loop / single))
+    print('{:>10} {:>10.4f} {:>8.1f}'.format('batch', batch, loop / batch))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for NonArrhenius models')
+    parser.add_argument('--oil_type', default='chichimene')
+    parser.add_argument('--experiment', default='0 PSI')
+    parser.add_argument('--interpnum', type=int, default=200)
+    parser.add_argument('--repeats', type=int, default=3)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    threads_parser = subparsers.add_parser('threads', help=benchmark_threads.__doc__.strip())
+    threads_parser.add_argument('--grid', type=int, default=200, help='grid points per axis')
+    threads_parser.add_argument('--max_threads', type=int, default=None)
+    threads_parser.set_defaults(func=benchmark_threads)
+
+    scalar_parser = subparsers.add_parser('scalar', help=benchmark_scalar.__doc__.strip())
+    scalar_parser.add_argument('--calls', type=int, default=2000)
+    scalar_parser.set_defaults(func=benchmark_scalar)
+
+    cutoff_parser = subparsers.add_parser('cutoff', help=benchmark_cutoff.__doc__.strip())
+    cutoff_parser.add_argument('--cutoffs', type=float, nargs='+', default=[6.0, 7.0, 8.0])
+    cutoff_parser.add_argument('--tau', type=float, default=None, help='kernel width, defaults to the model tau')
+    cutoff_parser.set_defaults(func=benchmark_cutoff)
+
+    find_parser = subparsers.add_parser('find_start_end', help=benchmark_find_start_end.__doc__.strip())
+    find_parser.add_argument('--samples', type=int, default=200000, help='samples per series')
+    find_parser.add_argument('--series', type=int, default=10)
+    find_parser.set_defaults(func=benchmark_find_start_end)
+
+    args = parser.parse_args()
+    args.func(args)
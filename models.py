@@ -4,17 +4,244 @@ import matplotlib.pyplot as plt
 import tikzplotlib as tikz
 import os
 import re
+import hashlib
+import json
+import itertools
+import multiprocessing
 
 from scipy.integrate import solve_ivp, cumtrapz
 from scipy.optimize import minimize
-from scipy.interpolate import griddata
+from scipy.interpolate import LinearNDInterpolator, RectBivariateSpline
+from scipy.spatial import Delaunay, cKDTree
 from scipy.stats import linregress, norm, truncnorm
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
-def load_rto_data(data_path, clean_data = True, return_O2_con_in = False):
+def load_heating_rate(data_path, interpnum, clean_data = True, cache = False, cache_dir = None, dtype = None):
+    '''
+    Load an RTO experiment with load_rto_data and downsample it to interpnum points evenly spaced in 
+        time, or keep all samples if interpnum is None
+
+    Returns:
+        Time, Temp, O2_conversion, dO2_conversion - downsampled arrays
+
+    '''
+
+    Time, dO2_conversion, O2_conversion, Temp = load_rto_data(data_path, clean_data=clean_data, cache=cache, 
+                                                                cache_dir=cache_dir, dtype=dtype)
+
+    if interpnum is None:
+        return Time, Temp, O2_conversion, dO2_conversion
+
+    time_downsampled = np.linspace(Time.min(), Time.max(), num=interpnum)
+
+    return (time_downsampled, np.interp(time_downsampled, Time, Temp), 
+            np.interp(time_downsampled, Time, O2_conversion), np.interp(time_downsampled, Time, dO2_conversion))
+
+
+def adaptive_sample_indices(curves, tol, max_points, num_points = None):
+    '''
+    Pick samples of full resolution curves so that linear interpolation in time between them stays 
+        within tol of the curves. Errors are measured on temperature relative to its range, on 
+        conversion and on conversion rate relative to its peak. Samples are added where the error is 
+        largest, so they concentrate where conversion and its rate change fastest. 
+
+    All curves get the same number of samples, the number the hardest curve needs (at most 
+        max_points) unless num_points is given, so they still stack into training arrays with one row 
+        per curve. 
+
+    Inputs:
+        curves - list of (Time, Temp, O2 conversion, conversion rate) at full resolution
+        tol - maximum normalized interpolation error
+        max_points - maximum number of samples per curve
+        num_points - number of samples of every curve, at most max_points and the length of the 
+            shortest curve
+
+    Returns:
+        inds - list of sample index arrays, one per curve
+        errors - maximum normalized interpolation error of each curve, above tol only if a curve 
+            needs more samples than allowed
+
+    '''
+
+    def normalized(curve):
+        Temp, X, dX = curve[1], curve[2], curve[3]
+        return np.vstack([(Temp - Temp.min()) / max(np.ptp(Temp), 1e-12), X, dX / max(np.amax(np.abs(dX)), 1e-12)])
+
+    def interp_error(Time, Y, knots):
+        return np.amax(np.abs(Y - np.vstack([np.interp(Time, Time[knots], y[knots]) for y in Y])), axis=0)
+
+    def refine(Time, Y, knots, tol, num_points):
+        # Add the worst sample of every segment with error above tol until none is left or num_points is reached
+        while knots.shape[0] < num_points:
+            err = interp_error(Time, Y, knots)
+            seg = np.searchsorted(knots, np.arange(Time.shape[0]), side='right') - 1
+            order = np.lexsort((-err, seg))
+            worst = order[np.concatenate([[True], seg[order][1:] != seg[order][:-1]])]
+            worst = worst[err[worst] > tol]
+            if worst.shape[0] == 0:
+                break
+            worst = worst[np.argsort(-err[worst], kind='stable')][:num_points - knots.shape[0]]
+            knots = np.union1d(knots, worst)
+        return knots
+
+    def pad(Time, Y, knots, tol, num_points, tries = 8):
+        # Add samples one at a time up to num_points. A new knot changes the chords next to it, so 
+        # of the worst samples the first that keeps the error within tol (or within the current error 
+        # if that is larger) is taken, otherwise the one giving the smallest error. 
+        err = interp_error(Time, Y, knots)
+        while knots.shape[0] < num_points:
+            limit = max(tol, np.amax(err))
+            unused = np.setdiff1d(np.arange(Time.shape[0]), knots)
+            best = None
+            for c in unused[np.argsort(-err[unused], kind='stable')][:tries]:
+                trial = np.union1d(knots, [c])
+                trial_err = interp_error(Time, Y, trial)
+                if best is None or np.amax(trial_err) < np.amax(best[1]):
+                    best = (trial, trial_err)
+                if np.amax(trial_err) <= limit:
+                    break
+            knots, err = best
+        return knots, np.amax(err)
+
+    max_points = min([max_points] + [curve[0].shape[0] for curve in curves])
+    if num_points is not None:
+        max_points = min(max_points, num_points)
+    Ys = [normalized(curve) for curve in curves]
+    inds = [refine(curve[0], Y, np.array([0, curve[0].shape[0] - 1]), tol, max_points) 
+            for curve, Y in zip(curves, Ys)]
+
+    # Pad every curve to the common number of samples. If a curve ends up above tol, refine it 
+    # further and raise the common number, up to max_points. 
+    while True:
+        L = max([ind.shape[0] for ind in inds] + [0]) if num_points is None else max_points
+        padded = [pad(curve[0], Y, ind, tol, L) for curve, Y, ind in zip(curves, Ys, inds)]
+        errors = [error for _, error in padded]
+        over = [i for i, error in enumerate(errors) if error > tol]
+        if len(over) == 0 or L >= max_points:
+            break
+        for i in over:
+            inds[i] = refine(curves[i][0], Ys[i], padded[i][0], tol, max_points)
+    inds = [knots for knots, _ in padded]
+
+    return inds, errors
+
+
+# Columns used from RTO data files, the temperature is stored as either Temperature or Temp
+RTO_COLUMNS = ['Time', 'O2', 'CO2', 'Temperature', 'Temp']
+
+
+def read_rto_excel(path):
+    return pd.read_excel(path, usecols=lambda column: column in RTO_COLUMNS)
+
+
+def read_rto_csv(path):
+    return pd.read_csv(path, usecols=lambda column: column in RTO_COLUMNS)
+
+
+def read_rto_columnar(reader, path):
+    '''
+    Read the RTO columns with a pandas reader that takes a list of columns (Parquet, Feather). 
+        Columns cannot be skipped if missing, so each name of the temperature column is tried. 
+    '''
+    for temp in ['Temperature', 'Temp']:
+        try:
+            return reader(path, columns=['Time', 'O2', 'CO2', temp])
+        except (KeyError, ValueError):
+            pass
+    return reader(path, columns=['Time', 'O2', 'CO2'])
+
+
+def read_rto_parquet(path):
+    return read_rto_columnar(pd.read_parquet, path)
+
+
+def read_rto_feather(path):
+    return read_rto_columnar(pd.read_feather, path)
+
+
+def read_rto_npy(path):
+    '''
+    Read a structured .npy array with fields named as the RTO columns. Only the used fields are read 
+        from the memory-mapped file. 
+    '''
+    data = np.load(path, mmap_mode='r')
+    if data.dtype.names is None:
+        raise Exception('{} is not a structured array with fields {}.'.format(path, ', '.join(RTO_COLUMNS)))
+    return pd.DataFrame({name: np.asarray(data[name]) for name in data.dtype.names if name in RTO_COLUMNS})
+
+
+# Readers of RTO data files by extension, in order of preference when a file exists in several formats
+RTO_READERS = OrderedDict([('.xls', read_rto_excel), ('.xlsx', read_rto_excel), ('.csv', read_rto_csv), 
+                           ('.parquet', read_rto_parquet), ('.feather', read_rto_feather), ('.npy', read_rto_npy)])
+
+
+def find_rto_file(data_path):
+    '''
+    Path of the RTO data file for data_path. Without a supported extension the extensions of 
+        RTO_READERS are tried in order. 
+    '''
+    if os.path.splitext(data_path)[1].lower() in RTO_READERS:
+        return data_path
+    for ext in RTO_READERS:
+        if os.path.exists(data_path + ext):
+            return data_path + ext
+    raise Exception('No RTO data file found for {} (supported formats: {}).'.format(data_path, ', '.join(RTO_READERS)))
+
+
+# Bump when the processing in load_rto_data changes so that cached results are not reused
+RTO_CACHE_VERSION = 1
 
-    df = pd.read_excel(data_path + '.xls')
+# Model files written by NonArrheniusBase.save start with MODEL_FILE_MAGIC, bump the version when 
+# the saved state changes
+MODEL_FILE_MAGIC = b'NAMODEL\x00'
+MODEL_FILE_VERSION = 5
+MODEL_FILE_ALIGN = 64
+
+
+def load_rto_data(data_path, clean_data = True, return_O2_con_in = False, cache = False, cache_dir = None, 
+                  dtype = None):
+    '''
+    Load and process an RTO experiment from data_path, with or without the extension of one of the 
+        formats in RTO_READERS. Only the Time, O2, CO2 and temperature columns are read, and dtype 
+        (e.g. np.float32) converts them after reading. 
+
+    With cache=True the processed arrays are stored as a binary .npy file keyed by the path, 
+        modification time and size of the data file, clean_data and dtype, and later loads return 
+        read-only memory-mapped views of it instead of parsing the data file again. The cache lives 
+        in cache_dir, by default a .rto_cache directory next to the data file. 
+
+    '''
+
+    file_path = find_rto_file(data_path)
+
+    if cache:
+        stat = os.stat(file_path)
+        key = hashlib.sha256(repr((os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size, 
+                                   bool(clean_data), None if dtype is None else np.dtype(dtype).str, 
+                                   RTO_CACHE_VERSION)).encode()).hexdigest()
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(file_path)), '.rto_cache')
+        cache_path = os.path.join(cache_dir, key + '.npy')
+
+        if os.path.exists(cache_path):
+            Time, dO2_conversion, O2_conversion, Temp = np.load(cache_path, mmap_mode='r')
+            return Time, dO2_conversion, O2_conversion, Temp
+
+        data = load_rto_data(file_path, clean_data=clean_data, dtype=dtype)
+
+        # Write under a temporary name so other processes never read a partial file
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(cache_path[:-4], os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.vstack(data))
+        os.replace(tmp_path, cache_path)
+
+        return data
+
+    df = RTO_READERS[os.path.splitext(file_path)[1].lower()](file_path)
     
     # Read in data
     Time = df.Time.values/60
@@ -25,74 +252,168 @@ def load_rto_data(data_path, clean_data = True, return_O2_con_in = False):
     elif hasattr(df, 'Temp'):
         Temp = df.Temp.values
     else:
-        raise Exception('Input data file {} does not contain valid field for temperature.'.format(data_path + '.xls'))
-
-
-    if clean_data:
-        ind100C = np.amin(np.asarray(Temp > 100).nonzero())
-        ind120C = np.amin(np.asarray(Temp > 120).nonzero())
-        inds750 = np.asarray(Temp > 745).nonzero()[0]
-        ind750C1 = inds750[np.round(0.75*inds750.shape[0]).astype(int)]
-        ind750C2 = inds750[np.round(0.9*inds750.shape[0]).astype(int)]
-        
-        # Gather datapoints and perform linear regression correction
-        correction_times = np.concatenate([Time[ind100C:ind120C+1], Time[ind750C1:ind750C2+1]])
-        correction_O2s = np.concatenate([O2[ind100C:ind120C+1], O2[ind750C1:ind750C2+1]])
-        slope, intercept, _, _, _ = linregress(correction_times, correction_O2s)
-        O2_baseline = slope*Time + intercept
-        O2_con_in = intercept
-    else:
-        O2_baseline = O2[0]*np.ones_like(Time)
-        O2_con_in = O2[0]
+        raise Exception('Input data file {} does not contain valid field for temperature.'.format(file_path))
 
-    # Calculate %O2 consumption and conversion
-    O2_consumption = np.maximum(O2_baseline - O2, 0)
-    
-    start_ind_max, end_ind_max_O2 = find_start_end(O2_consumption)
-    O2_consumption[:start_ind_max] = 0
-    O2_consumption[end_ind_max_O2:] = 0
-    
-    # Finalize temperature and consumption data
-    Time = Time[:end_ind_max_O2]
-    Temp = Temp[:end_ind_max_O2]
-    O2_consumption = O2_consumption[:end_ind_max_O2]
-
-    # Calculate %O2 conversion
-    O2_conversion = cumtrapz(O2_consumption, x=Time, initial=0)
-    O2_conversion /= O2_conversion[-1]
-    dO2_conversion = np.gradient(O2_conversion, Time)
+    if dtype is not None:
+        Time, O2, Temp = Time.astype(dtype), O2.astype(dtype), Temp.astype(dtype)
+
+    return clean_rto_batch([Time], [O2], [Temp], clean_data=clean_data)[0]
+
+
+def clean_rto_batch(Times, O2s, Temps, clean_data = True):
+    '''
+    Clean raw RTO series and compute their O2 conversion and conversion rate. The baseline windows 
+        are found with vectorized scans of each series and the consumption runs of all series are 
+        found in one pass (see find_start_end_batch). 
+
+    Inputs:
+        Times - list of time arrays in minutes
+        O2s - list of O2 concentration arrays
+        Temps - list of temperature arrays
+        clean_data - whether to correct the O2 baseline by linear regression over the 100-120C and 
+            the late 745C windows, otherwise the first O2 value is used as baseline
+
+    Returns:
+        data - list of (Time, dO2_conversion, O2_conversion, Temp) for each series
+
+    '''
+
+    O2_consumptions = []
+    for Time, O2, Temp in zip(Times, O2s, Temps):
+        if clean_data:
+            above100C, above120C, above745C = Temp > 100, Temp > 120, Temp > 745
+            if not above120C.any():
+                raise Exception('Temperature never exceeds 120C, cannot find the baseline window.')
+            ind100C = np.argmax(above100C)
+            ind120C = np.argmax(above120C)
+            inds750 = np.flatnonzero(above745C)
+            ind750C1 = inds750[np.round(0.75*inds750.shape[0]).astype(int)]
+            ind750C2 = inds750[np.round(0.9*inds750.shape[0]).astype(int)]
+            
+            # Gather datapoints and perform linear regression correction
+            correction_times = np.concatenate([Time[ind100C:ind120C+1], Time[ind750C1:ind750C2+1]])
+            correction_O2s = np.concatenate([O2[ind100C:ind120C+1], O2[ind750C1:ind750C2+1]])
+            slope, intercept, _, _, _ = linregress(correction_times, correction_O2s)
+            O2_baseline = slope*Time + intercept
+        else:
+            O2_baseline = O2[0]*np.ones_like(Time)
+
+        # Calculate %O2 consumption
+        O2_consumptions.append(np.maximum(O2_baseline - O2, 0))
+
+    data = []
+    for Time, Temp, O2_consumption, (start_ind_max, end_ind_max_O2) in zip(Times, Temps, O2_consumptions, 
+                                                                         find_start_end_batch(O2_consumptions)):
+        O2_consumption[:start_ind_max] = 0
+        O2_consumption[end_ind_max_O2:] = 0
+        
+        # Finalize temperature and consumption data
+        Time = Time[:end_ind_max_O2]
+        Temp = Temp[:end_ind_max_O2]
+        O2_consumption = O2_consumption[:end_ind_max_O2]
+
+        # Calculate %O2 conversion
+        O2_conversion = cumtrapz(O2_consumption, x=Time, initial=0)
+        O2_conversion /= O2_conversion[-1]
+        dO2_conversion = np.gradient(O2_conversion, Time)
+
+        data.append((Time, dO2_conversion, O2_conversion, Temp))
     
-    return Time, dO2_conversion, O2_conversion, Temp
+    return data
     
 
 def find_start_end(x):
     '''
-    Find start and end indices from array x
+    Find start and end indices from array x: the run of positive values with the largest sum, see 
+        find_start_end_batch
     
     '''
     
-    start_ind = 0
-    end_ind = 0
-    start_ind_max = 0
-    end_ind_max = x.shape[0]
-    cumsum = 0.0
-    max_cumsum = 0.0
-    for i in range(x.shape[0]):
-        if x[i] <= 0:
-            if cumsum > max_cumsum:
-                max_cumsum = cumsum
-                start_ind_max = start_ind
-                end_ind_max = end_ind
-            
-            cumsum = 0.0
-            start_ind = i
-            end_ind = i
-                
-        else:
-            cumsum += x[i]
-            end_ind += 1
-    
-    return start_ind_max, end_ind_max
+    return find_start_end_batch([x])[0]
+
+
+def find_start_end_batch(xs):
+    '''
+    Find start and end indices of the run of positive values with the largest sum in each array of xs. 
+        Runs only count once closed by a non-positive value. A run closed at index q that follows the 
+        non-positive value at p gives (p, q-1); the run at the start of an array gives (0, q). The 
+        first of equal runs wins, and (0, len(x)) is returned if no run has a positive sum. 
+
+    All arrays are scanned together. Runs are ranked by np.add.reduceat sums, and the runs within 
+        rounding error of the largest are summed again left to right with np.cumsum (np.add.reduceat 
+        sums pairwise), so sums and ties match a sequential scan. 
+
+    Inputs:
+        xs - list of 1D arrays
+
+    Returns:
+        inds - list of (start index, end index) for each array
+
+    '''
+
+    xs = [np.asarray(x, dtype=float) for x in xs]
+    lengths = np.array([x.shape[0] for x in xs], dtype=int)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(int)
+    x = np.concatenate(xs) if len(xs) > 0 else np.zeros(0)
+
+    # Non-positive values close runs, each run starts after the previous closing value of its array
+    stops = np.flatnonzero(x <= 0)
+    series = np.searchsorted(offsets, stops, side='right') - 1
+    prev = np.concatenate([[-1], stops[:-1]])
+    first = np.ones(stops.shape[0], dtype=bool)
+    first[1:] = series[1:] != series[:-1]
+    prev[first] = offsets[series[first]] - 1
+
+    # Approximate run sums. Runs containing NaN are never selected, as in a sequential scan where 
+    # their sum is NaN, and empty runs have sum 0. 
+    run_lengths = stops - prev - 1
+    approx = np.full(stops.shape[0], -np.inf)
+    if stops.shape[0] > 0:
+        approx = np.add.reduceat(x, np.column_stack([prev + 1, stops]).ravel())[::2]
+        approx[(run_lengths == 0) | np.isnan(approx)] = -np.inf
+
+    # Runs hold positive values only, so any summation order is within L*eps relative of the exact 
+    # sum, and only runs that close to the largest run of their array can be the largest run
+    candidates = np.zeros(0, dtype=int)
+    if stops.shape[0] > 0:
+        group_starts = np.flatnonzero(first)
+        group = np.cumsum(first) - 1
+        group_max = np.maximum.reduceat(approx, group_starts)[group]
+        # Arrays without a positive run have group_max -inf and no candidates
+        tol = np.zeros(stops.shape[0])
+        finite = np.isfinite(group_max)
+        tol[finite] = 4 * np.finfo(float).eps * (run_lengths + np.maximum.reduceat(run_lengths, group_starts)[group])[finite] * group_max[finite]
+        candidates = np.flatnonzero((approx >= group_max - tol) & (approx > 0))
+
+    # Exact sums of the candidates, accumulated left to right along the rows of a block of runs of 
+    # equal length
+    cand_lengths = run_lengths[candidates]
+    order = np.argsort(cand_lengths, kind='stable')
+    sums = np.zeros(candidates.shape[0])
+    for rows in np.split(order, np.flatnonzero(np.diff(cand_lengths[order])) + 1):
+        if rows.shape[0] > 0:
+            starts = prev[candidates[rows]] + 1
+            sums[rows] = np.cumsum(x[starts[:,None] + np.arange(cand_lengths[rows[0]])], axis=1)[:,-1]
+
+    inds = [(0, int(n)) for n in lengths]
+    valid = sums > 0
+    if np.any(valid):
+        candidates, sums = candidates[valid], sums[valid]
+        cand_series = series[candidates]
+
+        # First maximum of each array
+        group_starts = np.flatnonzero(np.concatenate([[True], cand_series[1:] != cand_series[:-1]]))
+        group_max = np.maximum.reduceat(sums, group_starts)
+        is_max = sums == np.repeat(group_max, np.diff(np.append(group_starts, sums.shape[0])))
+        best = np.flatnonzero(is_max)
+        best = best[np.concatenate([[True], cand_series[best][1:] != cand_series[best][:-1]])]
+
+        for k in candidates[best]:
+            i = series[k]
+            start = max(prev[k] - offsets[i], 0)
+            inds[i] = (int(start), int(start + stops[k] - 1 - prev[k]))
+
+    return inds
 
 
 def create_simulation_overlays(nainterp, naml, data_container, save_path):
@@ -126,43 +447,300 @@ def create_simulation_overlays(nainterp, naml, data_container, save_path):
                             save_path=save_path[:-4]+'_{}'.format(hr)+save_path[-4:])
 
 
-class NonArrheniusBase(ABC):
-    
+def update_hash(h, obj):
+    '''
+    Feed the contents of obj (arrays, splines, nested lists, tuples and dicts or plain values) into 
+        the hashlib object h
+    '''
+    if isinstance(obj, np.ndarray):
+        h.update('{}{}'.format(obj.dtype.str, obj.shape).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, RectBivariateSpline):
+        for arr in list(obj.get_knots()) + [obj.get_coeffs()]:
+            update_hash(h, arr)
+    elif isinstance(obj, (list, tuple)):
+        h.update('{}{}'.format(type(obj).__name__, len(obj)).encode())
+        for item in obj:
+            update_hash(h, item)
+    elif isinstance(obj, dict):
+        update_hash(h, sorted(obj.items(), key=lambda item: item[0]))
+    else:
+        h.update(repr(obj).encode())
+
+
+# Fitted models of the simulation worker processes, set once per worker by init_simulation_worker
+worker_models = None
+
+
+def init_simulation_worker(models):
+    global worker_models
+    worker_models = models
+
+
+def run_simulation_task(task):
+    model_index, y0, tspan, heating, kwargs = task
+    t, y = worker_models[model_index].simulate_rto(y0, tspan, heating, **kwargs)
+    return t, y[-1]
+
+
+def simulate_rto_parallel(models, tasks, n_workers = None):
+    '''
+    Simulate many (model, heating program) pairs on a process pool. The models are handed to each 
+        worker once when the pool starts (inherited without pickling where processes are forked), so 
+        tasks only carry the heating programs. 
+
+    Inputs:
+        models - list of fitted models
+        tasks - list of tuples (model index, y0, tspan, heating) or (model index, y0, tspan, heating, 
+            kwargs) with kwargs a dict of further simulate_rto arguments such as max_temp or method
+        n_workers - number of worker processes, defaults to the number of CPUs
+
+    Returns:
+        results - list of (t, O2 conversion) arrays in the order of tasks, e.g. for compute_sim_mse 
+            with sim_data = {'Time': t, 'O2conv': O2 conversion}
+
+    '''
+
+    tasks = [tuple(task) if len(task) == 5 else tuple(task) + ({},) for task in tasks]
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context, initializer=init_simulation_worker, 
+                             initargs=(models,)) as pool:
+        results = list(pool.map(run_simulation_task, tasks))
+
+    return results
+
+
+class RTOStream():
+    '''
+    Incremental processing of a running RTO experiment. Samples are passed in chunks as they arrive 
+        and each chunk is processed in time proportional to its own length: 
+
+        - Until the 120C window of the baseline correction has passed, O2 consumption is taken as 
+            zero. Afterwards the provisional baseline is the linear regression of O2 on time over the 
+            100-120C window, from running sums accumulated online. 
+        - The consumption integral (cumtrapz) and its gradient are extended from the last samples 
+            of the previous chunk. 
+        - Provisional conversion is the integral normalized by the O2 consumed so far. 
+
+    The exact baseline regression also needs the 745C plateau and the normalization needs the total 
+        consumption, so finalize processes the whole experiment once as load_rto_data does. 
+
+    '''
+
+    def __init__(self, clean_data = True):
+        self.clean_data = clean_data
+        self.chunks = {'Time': [], 'O2': [], 'CO2': [], 'Temp': [], 'integral': [], 'rate': []}
+        self.num_samples = 0
+
+        # Baseline window state: 0 before 100C, 1 inside the 100-120C window, 2 once it is complete
+        self.window_state = 0
+        # Running sums of 1, t, t^2, O2 and t*O2 over the window, with t relative to its first sample
+        self.window_sums = np.zeros(5)
+        self.window_t0 = None
+        # Slope and intercept of the provisional O2 baseline
+        self.baseline = None
+
+        # Last samples of the previous chunk
+        self.last_consumption = 0.0
+        self.last_integral = 0.0
+
+
+    def update(self, Time, O2, CO2, Temp):
+        '''
+        Process a chunk of new samples
+
+        Inputs:
+            Time - sample times in seconds, as in the analyzer files
+            O2, CO2, Temp - O2 and CO2 concentrations and temperatures of the samples
+
+        Returns:
+            Time, dO2_conversion, O2_conversion, Temp - provisional curves of the new samples, with 
+                conversion relative to the O2 consumed so far
+
+        '''
+
+        Time, O2, Temp = np.asarray(Time, dtype=float) / 60, np.asarray(O2, dtype=float), np.asarray(Temp, dtype=float)
+        n = Time.shape[0]
+        if n == 0:
+            return Time, np.zeros(0), np.zeros(0), Temp
+
+        consumption = np.zeros(n)
+        if not self.clean_data:
+            if self.baseline is None:
+                self.baseline = (0.0, O2[0])
+            consumption = np.maximum(self.baseline_O2(Time) - O2, 0)
+        else:
+            # Baseline window: from the first sample above 100C up to and including the first sample above 120C
+            start = 0
+            if self.window_state == 0:
+                above100C = np.flatnonzero(Temp > 100)
+                if above100C.shape[0] > 0:
+                    self.window_state, start = 1, above100C[0]
+                    self.window_t0 = Time[start]
+            if self.window_state == 1:
+                above120C = np.flatnonzero(Temp[start:] > 120)
+                stop = start + above120C[0] + 1 if above120C.shape[0] > 0 else n
+                t, x = Time[start:stop] - self.window_t0, O2[start:stop]
+                self.window_sums += [stop - start, np.sum(t), np.sum(t*t), np.sum(x), np.sum(t*x)]
+                if above120C.shape[0] > 0:
+                    self.window_state, self.baseline = 2, self.window_regression()
+                    consumption[stop:] = np.maximum(self.baseline_O2(Time[stop:]) - O2[stop:], 0)
+            elif self.window_state == 2:
+                consumption = np.maximum(self.baseline_O2(Time) - O2, 0)
+
+        # Extend the trapezoidal integral from the last sample of the previous chunk
+        if self.num_samples > 0:
+            t_prev = np.concatenate([[self.chunks['Time'][-1][-1]], Time])
+            c_prev = np.concatenate([[self.last_consumption], consumption])
+            integral = self.last_integral + np.cumsum(0.5*(c_prev[1:] + c_prev[:-1])*np.diff(t_prev))
+        else:
+            integral = np.concatenate([[0.0], np.cumsum(0.5*(consumption[1:] + consumption[:-1])*np.diff(Time))])
+
+        # Gradient with the last two samples of the history, which also updates the one-sided 
+        # difference of the previous last sample to a central one
+        t_hist, i_hist = self.history_tail()
+        t_ext, i_ext = np.concatenate([t_hist, Time]), np.concatenate([i_hist, integral])
+        rate = np.gradient(i_ext, t_ext) if t_ext.shape[0] > 1 else np.zeros(1)
+        if t_hist.shape[0] > 0:
+            self.chunks['rate'][-1][-1] = rate[t_hist.shape[0] - 1]
+        rate = rate[t_hist.shape[0]:]
+
+        for key, value in zip(['Time', 'O2', 'CO2', 'Temp', 'integral', 'rate'], 
+                              [Time, O2, np.asarray(CO2, dtype=float), Temp, integral, rate]):
+            self.chunks[key].append(value)
+        self.num_samples += n
+        self.last_consumption, self.last_integral = consumption[-1], integral[-1]
+
+        scale = 1.0 / self.last_integral if self.last_integral > 0 else 0.0
+        return Time, rate*scale, integral*scale, Temp
+
+
+    def window_regression(self):
+        '''
+        Slope and intercept of the least squares line of O2 on time over the baseline window, from 
+            the running sums. A window without spread in time gives its mean O2. 
+        '''
+        n, St, Stt, Sx, Stx = self.window_sums
+        var = n*Stt - St**2
+        slope = (n*Stx - St*Sx) / var if var > 0 else 0.0
+        return slope, (Sx - slope*St) / n - slope*self.window_t0
+
+
+    def baseline_O2(self, Time):
+        '''
+        Provisional O2 baseline at times Time (minutes)
+        '''
+        slope, intercept = self.baseline
+        return slope*Time + intercept
+
+
+    def history_tail(self):
+        '''
+        Times and consumption integral of the last two samples processed so far
+        '''
+        t, i = [], []
+        for chunk_t, chunk_i in zip(reversed(self.chunks['Time']), reversed(self.chunks['integral'])):
+            t, i = list(chunk_t[-2 + len(t):]) + t, list(chunk_i[-2 + len(i):]) + i
+            if len(t) >= 2:
+                break
+        return np.array(t), np.array(i)
+
+
+    def provisional(self):
+        '''
+        Provisional curves of all samples so far, normalized by the O2 consumed so far
+
+        Returns:
+            Time, dO2_conversion, O2_conversion, Temp
+
+        '''
+        if self.num_samples == 0:
+            return tuple(np.zeros(0) for _ in range(4))
+        scale = 1.0 / self.last_integral if self.last_integral > 0 else 0.0
+        return (np.concatenate(self.chunks['Time']), np.concatenate(self.chunks['rate'])*scale, 
+                np.concatenate(self.chunks['integral'])*scale, np.concatenate(self.chunks['Temp']))
+
+
+    def finalize(self):
+        '''
+        Final curves of the complete experiment, identical to load_rto_data on the same samples
+
+        Returns:
+            Time, dO2_conversion, O2_conversion, Temp
+
+        '''
+        return clean_rto_batch([np.concatenate(self.chunks['Time'])], [np.concatenate(self.chunks['O2'])], 
+                               [np.concatenate(self.chunks['Temp'])], clean_data=self.clean_data)[0]
+
+
+class RTODataset():
+    '''
+    RTO experiment from datasets/<oil_type>/<experiment>, loaded and downsampled once. Models built 
+        with dataset=... take their training arrays from it without reading or interpolating again. 
+
+    Curves are downsampled to interpnum points evenly spaced in time, or with downsample='adaptive' 
+        to the samples picked by adaptive_sample_indices for tolerance downsample_tol (at most 
+        interpnum per curve). 
+
+    Attributes:
+        heating_rates - heating rate names sorted by heating rate
+        Times - downsampled time points, one row per heating rate
+        Temps, O2convs, dXdt - downsampled temperature, conversion and conversion rate, one row per 
+            heating rate followed by the left (20C) and top (conversion=1) boundary condition rows
+        downsample_info - downsampling method, points per curve, number of training points M and, 
+            for adaptive downsampling, the tolerance and the maximum normalized interpolation error 
+            of each curve
+
+    '''
+
     def __init__(self, *args, **kwargs):
-        
-        # Set up data container 
+
         self.oil_type, self.experiment = kwargs['oil_type'], kwargs['experiment'] 
 
         kwargs.setdefault('heating_rates', None)
         kwargs.setdefault('clean_data', True)
         kwargs.setdefault('interpnum', 200)
+        kwargs.setdefault('cache_data', False)
+        kwargs.setdefault('cache_dir', None)
+        kwargs.setdefault('load_workers', 1)
+        kwargs.setdefault('load_executor', 'threads')
+        kwargs.setdefault('dtype', None)
+        kwargs.setdefault('downsample', 'uniform')
+        kwargs.setdefault('downsample_tol', 3e-3)
+
+        if kwargs['load_executor'] not in ['threads', 'processes']:
+            raise Exception('Invalid load executor {} entered.'.format(kwargs['load_executor']))
+        if kwargs['downsample'] not in ['uniform', 'adaptive']:
+            raise Exception('Invalid downsampling mode {} entered.'.format(kwargs['downsample']))
 
         expdirname = os.path.join('datasets', self.oil_type, self.experiment)
 
         if kwargs['heating_rates'] is None:
-            hr_names = [name[:-4] for name in os.listdir(expdirname) if name[-4:].lower()=='.xls']
+            hr_names = sorted(set(os.path.splitext(name)[0] for name in os.listdir(expdirname) 
+                                  if os.path.splitext(name)[1].lower() in RTO_READERS))
         else:
             hr_names = kwargs['heating_rates']
         
-        hr_inds = np.argsort(np.array([float(re.findall(r"[-+]?\d*\.\d+|\d+", h)[0]) for h in hr_names]))
-        hr_names = [hr_names[i] for i in hr_inds]
-        self.heating_rates = hr_names
+        self.heating_rates = self.sort_heating_rates(hr_names)
 
-        # Begin loading data
-        Times, O2convs, Temps, dXdt = [], [], [], []
+        # Begin loading data, with adaptive downsampling at most interpnum points per curve are kept
         INTERPNUM = kwargs['interpnum']
-        
-        for hr in self.heating_rates:
-            # Read RTO data
-            Time, dO2_conversion, O2_conversion, Temp = load_rto_data(os.path.join(expdirname, hr), 
-                                                                        clean_data=kwargs['clean_data'])
-            
-            # Downsample and append
-            time_downsampled = np.linspace(Time.min(), Time.max(), num=INTERPNUM)
-            Times.append(time_downsampled)
-            Temps.append(np.interp(time_downsampled, Time, Temp))
-            O2convs.append(np.interp(time_downsampled, Time, O2_conversion))
-            dXdt.append(np.interp(time_downsampled, Time, dO2_conversion))
+        adaptive = kwargs['downsample'] == 'adaptive'
+        curves = self.load_curves([os.path.join(expdirname, hr) for hr in self.heating_rates], 
+                                  None if adaptive else INTERPNUM, 
+                                  kwargs['clean_data'], kwargs['cache_data'], kwargs['cache_dir'], 
+                                  kwargs['load_workers'], kwargs['load_executor'], kwargs['dtype'])
+        errors = None
+        if adaptive:
+            inds, errors = adaptive_sample_indices(curves, kwargs['downsample_tol'], INTERPNUM)
+            curves = [tuple(arr[ind] for arr in curve) for curve, ind in zip(curves, inds)]
+            INTERPNUM = inds[0].shape[0]
+        Times, Temps, O2convs, dXdt = [list(arrays) for arrays in zip(*curves)]
 
         # # Append boundary conditions
         # # Left BC - set rate at 20C to be 0 for all conversions
@@ -181,6 +759,132 @@ class NonArrheniusBase(ABC):
         self.O2convs = np.vstack(O2convs)
         self.Temps = np.vstack(Temps)
         self.dXdt = np.vstack(dXdt)
+        self.interpnum = INTERPNUM
+
+        # Number of training points and interpolation errors of the downsampled curves
+        self.downsample_info = {'method': kwargs['downsample'], 'tol': kwargs['downsample_tol'] if adaptive else None, 
+                                'points_per_curve': INTERPNUM, 'M': self.O2convs.size, 'max_errors': errors}
+
+
+    def load_curves(self, data_paths, interpnum, clean_data, cache, cache_dir, workers = 1, executor = 'threads', 
+                    dtype = None):
+        '''
+        Load and downsample heating rate files, optionally on a pool of worker threads or processes
+
+        Inputs:
+            data_paths - paths of the heating rate files, see load_rto_data
+            interpnum - number of points of each downsampled curve
+            clean_data, cache, cache_dir, dtype - passed on to load_rto_data
+            workers - number of files loaded concurrently
+            executor - 'threads' or 'processes'
+
+        Returns:
+            curves - list of (Time, Temp, O2 conversion, conversion rate) in the order of data_paths
+
+        '''
+
+        args = [(path, interpnum, clean_data, cache, cache_dir, dtype) for path in data_paths]
+
+        if workers > 1:
+            pool_class = ThreadPoolExecutor if executor == 'threads' else ProcessPoolExecutor
+            with pool_class(max_workers=workers) as pool:
+                futures = [pool.submit(load_heating_rate, *a) for a in args]
+        else:
+            futures = None
+
+        # Collect in file order, reporting every file that failed
+        curves, errors = [], []
+        for i, path in enumerate(data_paths):
+            try:
+                curves.append(futures[i].result() if futures is not None else load_heating_rate(*args[i]))
+            except Exception as e:
+                errors.append('{}: {}'.format(path, repr(e)))
+
+        if len(errors) > 0:
+            raise Exception('Failed to load {} heating rate file(s):\n{}'.format(len(errors), '\n'.join(errors)))
+
+        return curves
+
+
+    @staticmethod
+    def sort_heating_rates(hr_names):
+        '''
+        Sort heating rate names by the heating rate value they contain
+        '''
+        hr_inds = np.argsort(np.array([float(re.findall(r"[-+]?\d*\.\d+|\d+", h)[0]) for h in hr_names]))
+        return [hr_names[i] for i in hr_inds]
+
+
+    def subset_rows(self, heating_rates = None):
+        '''
+        Rows of Temps, O2convs and dXdt for a subset of heating rates, including the boundary 
+            condition rows. A slice when the rows are contiguous (so indexing gives views), otherwise 
+            an index array. 
+
+        Inputs:
+            heating_rates - list of heating rate names, defaults to all heating rates
+
+        Returns:
+            rows - slice or index array of rows
+            heating_rates - heating rate names of the subset in sorted order
+
+        '''
+
+        if heating_rates is None:
+            heating_rates = self.heating_rates
+
+        missing = [hr for hr in heating_rates if hr not in self.heating_rates]
+        if len(missing) > 0:
+            raise Exception('Heating rates {} are not in the dataset.'.format(missing))
+
+        heating_rates = self.sort_heating_rates(list(heating_rates))
+        inds = [self.heating_rates.index(hr) for hr in heating_rates]
+        num_hr = len(self.heating_rates)
+        rows = np.array(inds + [num_hr, num_hr + 1])
+
+        # The last heating rates are followed by the BC rows, so a slice selects them
+        if np.array_equal(rows, np.arange(rows[0], num_hr + 2)):
+            rows = slice(int(rows[0]), num_hr + 2)
+
+        return rows, heating_rates
+
+
+class NonArrheniusBase(ABC):
+    
+    def __init__(self, *args, **kwargs):
+        
+        # Set up data container, loading the experiment unless a dataset is passed in
+        kwargs.setdefault('dataset', None)
+        kwargs.setdefault('heating_rates', None)
+
+        if kwargs['dataset'] is None:
+            dataset = RTODataset(*args, **kwargs)
+            heating_rates = None
+        else:
+            dataset = kwargs['dataset']
+            heating_rates = kwargs['heating_rates']
+
+        self.oil_type, self.experiment = dataset.oil_type, dataset.experiment
+
+        # Training arrays are views of the dataset arrays where the rows allow it (see subset_rows)
+        rows, self.heating_rates = dataset.subset_rows(heating_rates)
+        if isinstance(rows, slice):
+            self.Times = dataset.Times[rows.start:rows.stop - 2]
+        else:
+            self.Times = dataset.Times[rows[:-2]]
+        self.O2convs = dataset.O2convs[rows]
+        self.Temps = dataset.Temps[rows]
+        self.dXdt = dataset.dXdt[rows]
+        self.dataset = dataset
+        self.interpnum = dataset.interpnum
+        self.downsample_info = dataset.downsample_info
+
+        # Opt-in tabulated rate surface and memoization cache, see tabulate_rates and enable_lookup_cache
+        self.rate_table = None
+        self.lookup_cache = None
+
+        # Opt-in on-disk cache of simulation results, see enable_simulation_cache
+        self.sim_cache = None
         
 
     def get_sim_func(self, heating, max_temp = 750):
@@ -213,10 +917,34 @@ class NonArrheniusBase(ABC):
         return f
     
     
+    def conversion_lookup(self, T, O2conv, **kwargs):
+        '''
+        Lookup conversion rate based on temperature and conversion. Served from the memoization cache 
+            (enable_lookup_cache) or the rate table (tabulate_rates) when enabled, otherwise from the 
+            model itself. 
+        
+        Inputs:
+            T - temperature or array-like of temperature values
+            O2conv - O2 conversion or array-like of O2 conversion values
+            kwargs - options passed on to exact_lookup
+        
+        Returns:
+            dO2conv - O2 conversion rate values 
+        
+        '''
+
+        if self.lookup_cache is not None:
+            return self.cached_lookup(T, O2conv, **kwargs)
+        elif self.rate_table is not None:
+            return self.table_lookup(T, O2conv)
+
+        return self.exact_lookup(T, O2conv, **kwargs)
+
+
     @abstractmethod
-    def conversion_lookup(self, T, O2conv):
+    def exact_lookup(self, T, O2conv, **kwargs):
         '''
-        Lookup conversion rate based on temperature and conversion.
+        Lookup conversion rate from the model, bypassing the rate table and memoization cache.
         
         Inputs:
             T - temperature or array-like of temperature values
@@ -227,42 +955,287 @@ class NonArrheniusBase(ABC):
         
         '''
         pass
-    
 
-    def overlay_curves(self, data_list, legend_entries=None, save_path = None):
+
+    def lookup_state(self):
         '''
-        data_dict - list of dictionary with keys 'Time', 'Temp', 'O2conv' to plot data
-        save_path - location to save the overlay
+        Objects and hyperparameters that conversion_lookup results depend on. The memoization cache 
+            is cleared whenever any of them is replaced or changes value. Subclasses add their own 
+            hyperparameters. 
+
         '''
-        plt.figure()
-        for i in range(len(self.heating_rates)):
-            plt.plot(self.Temps[i,:], self.O2convs[i,:], '--', 
-                        color=str(0.25+0.5*i/(len(self.heating_rates)-1)), ms=1.25)
-        legend_list = [str(h)+' C/min' for h in self.heating_rates]
+        return (self.Temps, self.O2convs, self.dXdt, self.rate_table)
 
-        for i in range(len(data_list)):
-            plt.plot(data_list[i]['Temp'], data_list[i]['O2conv'], ms=1.5)
 
-        if legend_entries is not None:
-            legend_list += legend_entries
-        
-        plt.title(r'$O_2$ Conversion Curves Overlay')
-        plt.xlabel('Temperature')
-        plt.ylabel(r'$O_2$ conversion')
-        plt.legend(legend_list, facecolor='white', framealpha=1)
+    def enable_lookup_cache(self, tol_T = 1e-2, tol_O2 = 1e-5, maxsize = 100000):
+        '''
+        Memoize conversion_lookup. Query coordinates are rounded to multiples of tol_T and tol_O2, 
+            and each rounded point is evaluated once and kept in an LRU cache of at most maxsize 
+            entries. Rates are always evaluated at the rounded point, so results do not depend on 
+            the order of queries, and differ from the exact rates by at most the change of the rate 
+            over half a tolerance step. 
 
-        if save_path is not None:
-            plt.savefig(save_path)
-            tikz.save(save_path)
+        The cache is cleared automatically when the training arrays, rate table or model 
+            hyperparameters (see lookup_state) are replaced. Training arrays edited in place are not 
+            detected, call clear_lookup_cache after such edits. 
 
-        plt.show()
-        
-    
-    def print_consumption_curves(self, save_path = None, legend=True):
-        gradplt = plt.figure()
-        convplt = plt.figure()
-        gradax = gradplt.add_subplot(111)
-        convax = convplt.add_subplot(111)
+        Inputs:
+            tol_T - temperature tolerance in C
+            tol_O2 - O2 conversion tolerance
+            maxsize - maximum number of cached points
+
+        '''
+        self.lookup_cache = OrderedDict()
+        self.lookup_cache_params = {'tol_T': tol_T, 'tol_O2': tol_O2, 'maxsize': maxsize}
+        self.clear_lookup_cache()
+
+
+    def disable_lookup_cache(self):
+        self.lookup_cache = None
+
+
+    def clear_lookup_cache(self):
+        self.lookup_cache.clear()
+        self.lookup_cache_state = self.lookup_state()
+        self.lookup_cache_stats = {'hits': 0, 'misses': 0}
+
+
+    def lookup_cache_info(self):
+        '''
+        Hit/miss statistics and size of the memoization cache
+        '''
+        info = dict(self.lookup_cache_stats)
+        info.update({'size': len(self.lookup_cache), 'maxsize': self.lookup_cache_params['maxsize']})
+        return info
+
+
+    def cached_lookup(self, T, O2conv, **kwargs):
+        '''
+        Lookup conversion rate through the memoization cache (see enable_lookup_cache)
+        '''
+
+        # Invalidate if anything the rates depend on has been replaced
+        state = self.lookup_state()
+        if len(state) != len(self.lookup_cache_state) or \
+                not all(a is b or (np.isscalar(a) and np.isscalar(b) and a == b) 
+                        for a, b in zip(state, self.lookup_cache_state)):
+            self.clear_lookup_cache()
+
+        tol_T, tol_O2 = self.lookup_cache_params['tol_T'], self.lookup_cache_params['tol_O2']
+        cache, stats = self.lookup_cache, self.lookup_cache_stats
+
+        def uncached(Tq, O2q):
+            if self.rate_table is not None:
+                return self.table_lookup(Tq, O2q)
+            return self.exact_lookup(Tq, O2q, **kwargs)
+
+        # Scalar queries from ODE right-hand sides
+        if np.isscalar(T) and np.size(O2conv) == 1:
+            key = (round(T / tol_T), round(np.asarray(O2conv).item() / tol_O2))
+            if key in cache:
+                stats['hits'] += 1
+                cache.move_to_end(key)
+                return cache[key]
+
+            stats['misses'] += 1
+            dO2conv = uncached(key[0]*tol_T, key[1]*tol_O2)
+            cache[key] = dO2conv
+            if len(cache) > self.lookup_cache_params['maxsize']:
+                cache.popitem(last=False)
+            return dO2conv
+
+        # Array queries: look up each distinct rounded point, evaluate all misses in one call
+        Tq, O2q = np.broadcast_arrays(np.asarray(T, dtype=float), np.asarray(O2conv, dtype=float))
+        keys = np.column_stack([np.round(Tq.flatten() / tol_T), np.round(O2q.flatten() / tol_O2)]).astype(np.int64)
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        unique_keys = [tuple(k) for k in unique_keys.tolist()]
+
+        values = np.empty(len(unique_keys))
+        misses = []
+        for i, key in enumerate(unique_keys):
+            if key in cache:
+                cache.move_to_end(key)
+                values[i] = cache[key]
+            else:
+                misses.append(i)
+        stats['hits'] += keys.shape[0] - len(misses)
+        stats['misses'] += len(misses)
+
+        if misses:
+            miss_keys = np.array([unique_keys[i] for i in misses], dtype=float)
+            values[misses] = uncached(miss_keys[:,0]*tol_T, miss_keys[:,1]*tol_O2)
+            for i in misses:
+                cache[unique_keys[i]] = values[i]
+            while len(cache) > self.lookup_cache_params['maxsize']:
+                cache.popitem(last=False)
+
+        return np.reshape(values[np.ravel(inverse)], Tq.shape)
+
+
+    def tabulate_rates(self, num_T = 200, num_O2 = 200, method = 'linear'):
+        '''
+        Evaluate the rate surface once on a regular (T, O2conv) grid over 20-750C and 0-1 conversion, 
+            then serve all later conversion_lookup calls from the table. Queries outside of the grid 
+            are clamped to its edges. 
+
+        Inputs:
+            num_T - number of temperature grid points
+            num_O2 - number of conversion grid points
+            method - 'linear' for bilinear or 'cubic' for bicubic interpolation of the table
+
+        Returns:
+            error - dictionary with max and RMS deviation of the table from the exact model, 
+                measured at the cell midpoints of the grid
+
+        '''
+
+        if method not in ['linear', 'cubic']:
+            raise Exception('Invalid table interpolation method {} entered.'.format(method))
+        k = 1 if method == 'linear' else 3
+
+        # Evaluate exact model on the grid
+        T_grid, O2_grid = np.linspace(20, 750, num=num_T), np.linspace(0, 1, num=num_O2)
+        Tq, O2q = np.meshgrid(T_grid, O2_grid, indexing='ij')
+        dXdt = self.exact_lookup(Tq, O2q)
+
+        # Deviation at cell midpoints, where the interpolation error is largest
+        T_mid, O2_mid = np.meshgrid((T_grid[1:] + T_grid[:-1])/2, (O2_grid[1:] + O2_grid[:-1])/2, indexing='ij')
+        dXdt_mid = self.exact_lookup(T_mid, O2_mid)
+
+        self.rate_table = RectBivariateSpline(T_grid, O2_grid, dXdt, kx=k, ky=k, s=0)
+        self.rate_table_bounds = (dXdt.min(), dXdt.max())
+        self.rate_table_grid = (T_grid, O2_grid, dXdt)
+        self.rate_table_method = method
+
+        err = self.table_lookup(T_mid, O2_mid) - dXdt_mid
+        self.rate_table_error = {'max': np.amax(np.abs(err)), 'rms': np.sqrt(np.mean(err**2))}
+
+        return self.rate_table_error
+
+
+    def table_lookup(self, T, O2conv):
+        '''
+        Lookup conversion rate from the table built by tabulate_rates
+        '''
+        Tq = np.clip(T, 20, 750)
+        O2q = np.clip(O2conv, 0, 1)
+
+        # Bicubic interpolation can overshoot, keep rates within the range of the table
+        dO2conv = np.clip(self.rate_table.ev(Tq, O2q), *self.rate_table_bounds)
+
+        if np.isscalar(T):
+            return dO2conv.item()
+
+        return dO2conv
+
+
+    def add_experiment(self, heating_rate, data = None, clean_data = True):
+        '''
+        Add one heating rate experiment to the fitted model without refitting it from scratch. The 
+            curve is downsampled like the training curves (interpnum points, evenly spaced in time or 
+            adaptive, see RTODataset) and inserted in heating rate order before the boundary 
+            condition rows, which do not depend on the curves. The lookup structures are then 
+            updated for the new points only (see add_training_rows). 
+
+        The training arrays are replaced rather than edited in place, so the dataset and other 
+            models sharing them are not changed. The model no longer refers to its dataset afterwards. 
+
+        Inputs:
+            heating_rate - name of the heating rate, e.g. '7C'
+            data - (Time, dO2_conversion, O2_conversion, Temp) as returned by load_rto_data or 
+                RTOStream.finalize. Defaults to loading datasets/<oil_type>/<experiment>/<heating_rate>. 
+            clean_data - passed on to load_rto_data when loading the experiment
+
+        '''
+
+        if heating_rate in self.heating_rates:
+            raise Exception('Heating rate {} is already in the model.'.format(heating_rate))
+
+        if data is None:
+            data = load_rto_data(os.path.join('datasets', self.oil_type, self.experiment, heating_rate), 
+                                 clean_data=clean_data)
+        Time, dO2_conversion, O2_conversion, Temp = [np.asarray(arr, dtype=float) for arr in data]
+
+        # Downsample to the number of points of the training curves
+        L = self.interpnum
+        info = dict(self.downsample_info)
+        if info['method'] == 'adaptive':
+            if Time.shape[0] < L:
+                raise Exception('Heating rate {} has {} samples, at least {} are needed.'.format(heating_rate, Time.shape[0], L))
+            inds, errors = adaptive_sample_indices([(Time, Temp, O2_conversion, dO2_conversion)], info['tol'], L, num_points=L)
+            if errors[0] > info['tol']:
+                raise Exception('Heating rate {} needs more than {} samples for downsampling tolerance {} (error {:.3g}).'.format(
+                                heating_rate, L, info['tol'], errors[0]))
+            curve = [arr[inds[0]] for arr in (Time, Temp, O2_conversion, dO2_conversion)]
+        else:
+            time_downsampled = np.linspace(Time.min(), Time.max(), num=L)
+            curve = [time_downsampled] + [np.interp(time_downsampled, Time, arr) for arr in (Temp, O2_conversion, dO2_conversion)]
+
+        # Insert the curve in heating rate order, in front of the BC rows
+        heating_rates = RTODataset.sort_heating_rates(self.heating_rates + [heating_rate])
+        pos = heating_rates.index(heating_rate)
+        self.heating_rates = heating_rates
+        self.Times = np.insert(self.Times, pos, curve[0], axis=0)
+        self.Temps = np.insert(self.Temps, pos, curve[1], axis=0)
+        self.O2convs = np.insert(self.O2convs, pos, curve[2], axis=0)
+        self.dXdt = np.insert(self.dXdt, pos, curve[3], axis=0)
+        self.dataset = None
+
+        info['M'] = self.O2convs.size
+        if info['max_errors'] is not None:
+            info['max_errors'] = info['max_errors'][:pos] + [errors[0]] + info['max_errors'][pos:]
+        self.downsample_info = info
+
+        self.add_training_rows(pos*L, L)
+
+
+    def add_training_rows(self, start, count):
+        '''
+        Update the model after count training points were inserted at index start of the flattened 
+            training arrays. Subclasses update their lookup structures and then call this, which 
+            rebuilds the rate table if there is one. The memoization and simulation caches see the 
+            new training arrays and do not return stale results. 
+
+        '''
+        if self.rate_table is not None:
+            T_grid, O2_grid, _ = self.rate_table_grid
+            self.tabulate_rates(T_grid.shape[0], O2_grid.shape[0], self.rate_table_method)
+    
+
+    def overlay_curves(self, data_list, legend_entries=None, save_path = None):
+        '''
+        data_dict - list of dictionary with keys 'Time', 'Temp', 'O2conv' to plot data
+        save_path - location to save the overlay
+        '''
+        plt.figure()
+        for i in range(len(self.heating_rates)):
+            plt.plot(self.Temps[i,:], self.O2convs[i,:], '--', 
+                        color=str(0.25+0.5*i/(len(self.heating_rates)-1)), ms=1.25)
+        legend_list = [str(h)+' C/min' for h in self.heating_rates]
+
+        for i in range(len(data_list)):
+            plt.plot(data_list[i]['Temp'], data_list[i]['O2conv'], ms=1.5)
+
+        if legend_entries is not None:
+            legend_list += legend_entries
+        
+        plt.title(r'$O_2$ Conversion Curves Overlay')
+        plt.xlabel('Temperature')
+        plt.ylabel(r'$O_2$ conversion')
+        plt.legend(legend_list, facecolor='white', framealpha=1)
+
+        if save_path is not None:
+            plt.savefig(save_path)
+            tikz.save(save_path)
+
+        plt.show()
+        
+    
+    def print_consumption_curves(self, save_path = None, legend=True):
+        gradplt = plt.figure()
+        convplt = plt.figure()
+        gradax = gradplt.add_subplot(111)
+        convax = convplt.add_subplot(111)
         
         for i in range(len(self.heating_rates)):
             gradax.plot(self.Temps[i,:], self.dXdt[i,:])
@@ -315,16 +1288,561 @@ class NonArrheniusBase(ABC):
         plt.show()
 
 
-    def simulate_rto(self, y0, tspan, heating, max_temp=750):
-        
-        f = self.get_sim_func(heating, max_temp = max_temp)
-        if not np.isscalar(heating):
-            times = heating[0]
+    def model_hash(self):
+        '''
+        Content hash of everything conversion_lookup results depend on: the training arrays and 
+            hyperparameters (see lookup_state), interpnum, the rate table and the lookup cache 
+            tolerances
+        '''
+        h = hashlib.sha256(type(self).__name__.encode())
+        update_hash(h, self.lookup_state())
+        update_hash(h, self.interpnum)
+        if self.rate_table is not None:
+            update_hash(h, self.rate_table_bounds)
+        if self.lookup_cache is not None:
+            update_hash(h, (self.lookup_cache_params['tol_T'], self.lookup_cache_params['tol_O2']))
+        return h.hexdigest()
+
+
+    def save(self, path):
+        '''
+        Write the fitted model to a single binary file that load() memory-maps. The file holds a 
+            JSON header with the class, version and hyperparameters (see save_state), followed by 
+            the raw training arrays and prebuilt lookup structures, each aligned to 
+            MODEL_FILE_ALIGN bytes. The memoization and simulation caches are not saved. 
+
+        Inputs:
+            path - file to write
+
+        '''
+
+        params, arrays = self.save_state()
+
+        # Lay out arrays after the header. Fortran ordered arrays keep their order (as in .npy files), 
+        # which keeps the summation order and so the results of lookups bit for bit. 
+        entries, offset = {}, 0
+        for name, arr in arrays.items():
+            arr = np.asarray(arr)
+            fortran_order = arr.ndim > 1 and arr.flags.f_contiguous and not arr.flags.c_contiguous
+            arrays[name] = np.ascontiguousarray(arr.T if fortran_order else arr)
+            entries[name] = {'dtype': arr.dtype.str, 'shape': arr.shape, 'fortran_order': fortran_order, 
+                             'offset': offset}
+            arr = arrays[name]
+            offset += -(-arr.nbytes // MODEL_FILE_ALIGN) * MODEL_FILE_ALIGN
+
+        header = json.dumps({'class': type(self).__name__, 'version': MODEL_FILE_VERSION, 
+                             'params': params, 'arrays': entries}, 
+                            default=lambda obj: obj.item() if isinstance(obj, np.generic) else obj.tolist()).encode()
+        header_size = -(-(len(MODEL_FILE_MAGIC) + 8 + len(header)) // MODEL_FILE_ALIGN) * MODEL_FILE_ALIGN
+        header = header.ljust(header_size - len(MODEL_FILE_MAGIC) - 8)
+
+        # Write to a temporary file first so readers never see a partial model
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(MODEL_FILE_MAGIC)
+            f.write(np.uint64(len(header)).tobytes())
+            f.write(header)
+            for name, arr in arrays.items():
+                f.seek(header_size + entries[name]['offset'])
+                f.write(arr.tobytes())
+            f.truncate(header_size + offset)
+        os.replace(tmp_path, path)
+
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load a model written by save(). Arrays are memory-mapped read-only, so loading takes 
+            milliseconds and processes loading the same file share its pages. Only cheap search 
+            structures (KD-trees and the Delaunay triangulation) are rebuilt. Loaded models have no 
+            dataset. 
+
+        Called on NonArrheniusBase, the class stored in the file is used, called on a subclass the 
+            file must hold that class. 
+
+        Inputs:
+            path - file written by save()
+
+        Returns:
+            model - fitted model
+
+        '''
+
+        with open(path, 'rb') as f:
+            magic = f.read(len(MODEL_FILE_MAGIC))
+            if magic != MODEL_FILE_MAGIC:
+                raise Exception('{} is not a model file.'.format(path))
+            header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_len).decode())
+        header_size = len(MODEL_FILE_MAGIC) + 8 + header_len
+
+        if header['version'] != MODEL_FILE_VERSION:
+            raise Exception('Model file version {} of {} is not supported, expected {}.'.format(
+                            header['version'], path, MODEL_FILE_VERSION))
+
+        classes = {model_cls.__name__: model_cls for model_cls in cls.__subclasses__()}
+        classes[cls.__name__] = cls
+        if header['class'] not in classes or getattr(classes[header['class']], '__abstractmethods__', None):
+            raise Exception('{} holds a {} model, which cannot be loaded as {}.'.format(path, header['class'], cls.__name__))
+
+        buffer = np.memmap(path, dtype=np.uint8, mode='r') if header['arrays'] else None
+        arrays = {}
+        for name, entry in header['arrays'].items():
+            dtype, shape = np.dtype(entry['dtype']), tuple(entry['shape'])
+            start = header_size + entry['offset']
+            arr = np.asarray(buffer[start:start + dtype.itemsize*int(np.prod(shape))]).view(dtype)
+            arrays[name] = arr.reshape(shape[::-1]).T if entry['fortran_order'] else arr.reshape(shape)
+
+        model = classes[header['class']].__new__(classes[header['class']])
+        model.load_state(header['params'], arrays)
+        return model
+
+
+    def save_state(self):
+        '''
+        Hyperparameters (JSON-serializable) and arrays written by save(). Subclasses add their own. 
+
+        Returns:
+            params - dictionary of hyperparameters
+            arrays - dictionary of arrays
+
+        '''
+
+        params = {'oil_type': self.oil_type, 'experiment': self.experiment, 'heating_rates': self.heating_rates, 
+                  'interpnum': self.interpnum, 'downsample_info': self.downsample_info, 
+                  'rate_table_method': None}
+        arrays = {'Times': self.Times, 'Temps': self.Temps, 'O2convs': self.O2convs, 'dXdt': self.dXdt}
+
+        if self.rate_table is not None:
+            params['rate_table_method'] = self.rate_table_method
+            params['rate_table_error'] = self.rate_table_error
+            arrays.update(zip(['rate_table_T', 'rate_table_O2', 'rate_table_dXdt'], self.rate_table_grid))
+
+        return params, arrays
+
+
+    def load_state(self, params, arrays):
+        '''
+        Restore the state written by save_state on a model created without __init__
+        '''
+
+        self.oil_type, self.experiment = params['oil_type'], params['experiment']
+        self.heating_rates = params['heating_rates']
+        self.interpnum = params['interpnum']
+        self.downsample_info = params['downsample_info']
+        self.Times, self.Temps, self.O2convs, self.dXdt = arrays['Times'], arrays['Temps'], arrays['O2convs'], arrays['dXdt']
+        self.dataset = None
+
+        self.rate_table = None
+        self.lookup_cache = None
+        self.sim_cache = None
+
+        # The table spline is cheap to refit from the saved grid
+        if params['rate_table_method'] is not None:
+            k = 1 if params['rate_table_method'] == 'linear' else 3
+            T_grid, O2_grid, dXdt = arrays['rate_table_T'], arrays['rate_table_O2'], arrays['rate_table_dXdt']
+            self.rate_table = RectBivariateSpline(T_grid, O2_grid, dXdt, kx=k, ky=k, s=0)
+            self.rate_table_bounds = (dXdt.min(), dXdt.max())
+            self.rate_table_grid = (T_grid, O2_grid, dXdt)
+            self.rate_table_method = params['rate_table_method']
+            self.rate_table_error = params['rate_table_error']
+
+
+    def enable_simulation_cache(self, cache_dir = 'sim_cache', max_bytes = 2**28):
+        '''
+        Keep simulate_rto (and so print_rto_experiment) results on disk. Results are keyed on a 
+            content hash of the model (see model_hash) and the simulation inputs, so the cache can be 
+            shared between sessions and models. Repeated simulations are read back without calling 
+            the solver. Each result is stored as a .npz file of its t and y arrays, and the least 
+            recently used files are deleted once the cache directory exceeds max_bytes. 
+
+        Inputs:
+            cache_dir - directory for the cached results
+            max_bytes - maximum total size of the cached results in bytes
+
+        '''
+        os.makedirs(cache_dir, exist_ok=True)
+        self.sim_cache = {'cache_dir': cache_dir, 'max_bytes': max_bytes}
+        self.sim_cache_stats = {'hits': 0, 'misses': 0}
+
+
+    def disable_simulation_cache(self):
+        self.sim_cache = None
+
+
+    def clear_simulation_cache(self):
+        for name in os.listdir(self.sim_cache['cache_dir']):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.sim_cache['cache_dir'], name))
+
+
+    def simulation_cache_info(self):
+        '''
+        Hit/miss statistics of this model and total size of the simulation cache directory
+        '''
+        files = [os.path.join(self.sim_cache['cache_dir'], name) for name in os.listdir(self.sim_cache['cache_dir']) 
+                 if name.endswith('.npz')]
+        info = dict(self.sim_cache_stats)
+        info.update({'files': len(files), 'bytes': sum(os.path.getsize(f) for f in files), 
+                     'max_bytes': self.sim_cache['max_bytes']})
+        return info
+
+
+    def simulate_rto(self, y0, tspan, heating, max_temp=750, method='RK45', breakpoints=None, **solver_kwargs):
+        '''
+        Simulate an RTO experiment, served from the simulation cache when enabled (see 
+            enable_simulation_cache). Inputs and outputs as for integrate_rto. 
+        '''
+
+        if self.sim_cache is None:
+            return self.integrate_rto(y0, tspan, heating, max_temp, method, breakpoints, **solver_kwargs)
+
+        h = hashlib.sha256(self.model_hash().encode())
+        update_hash(h, [np.asarray(y0, dtype=float), np.asarray(tspan, dtype=float), 
+                        np.asarray(heating, dtype=float), max_temp, method, 
+                        None if breakpoints is None else np.asarray(breakpoints, dtype=float), solver_kwargs])
+        path = os.path.join(self.sim_cache['cache_dir'], h.hexdigest() + '.npz')
+
+        if os.path.exists(path):
+            try:
+                with np.load(path) as data:
+                    t, y = data['t'], data['y']
+                os.utime(path) # mark as recently used
+                self.sim_cache_stats['hits'] += 1
+                return t, y
+            except (OSError, ValueError, KeyError):
+                pass # evicted or partially written by another process
+
+        self.sim_cache_stats['misses'] += 1
+        t, y = self.integrate_rto(y0, tspan, heating, max_temp, method, breakpoints, **solver_kwargs)
+
+        # Write under a temporary name so other processes never read a partial file
+        tmp_path = '{}.{}.tmp'.format(path[:-4], os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, t=t, y=y)
+        os.replace(tmp_path, path)
+        self.evict_simulation_cache()
+
+        return t, y
+
+
+    def evict_simulation_cache(self):
+        '''
+        Delete the least recently used simulation results until the cache fits in max_bytes
+        '''
+        entries = []
+        for name in os.listdir(self.sim_cache['cache_dir']):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.sim_cache['cache_dir'], name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(entry[1] for entry in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.sim_cache['max_bytes']:
+                break
+            try:
+                os.remove(os.path.join(self.sim_cache['cache_dir'], name))
+            except OSError:
+                pass
+            total -= size
+
+
+    def integrate_rto(self, y0, tspan, heating, max_temp=750, method='RK45', breakpoints=None, **solver_kwargs):
+        '''
+        Simulate an RTO experiment. Solver events stop the integration at full conversion and switch 
+            linear ramps to an isothermal system at max_temp, and heating programs are integrated 
+            segment by segment between their breakpoints, so the solver never steps across a kink. 
+            Implicit methods get the Jacobian from rate_jacobian. 
+
+        Inputs:
+            y0 - initial condition, [Temp, O2 conversion] for a linear ramp or [O2 conversion] for a 
+                heating program
+            tspan - time span for simulation
+            heating - either linear heating rate (scalar value) or list of form [Time, Temps]
+            max_temp - maximum temperature of a linear ramp
+            method - solve_ivp method, e.g. 'RK45' or the implicit 'Radau', 'BDF' or 'LSODA' for stiff 
+                ramps
+            breakpoints - times at which a heating program is split, detected with heating_breakpoints 
+                if None
+            solver_kwargs - passed on to solve_ivp
+
+        Returns:
+            t - time points
+            y - solution at time points, rows [Temp, O2 conversion] for a linear ramp or [O2 conversion] 
+                for a heating program
+
+        '''
+
+        implicit = method in ['Radau', 'BDF', 'LSODA']
+        t0, tf = tspan
+
+        def full_conversion(t, y):
+            return y[-1] - 1.0
+        full_conversion.terminal = True
+        full_conversion.direction = 1
+
+        if np.isscalar(heating):
+            T, X = float(y0[0]), float(y0[1])
+            ts, ys = [np.array([t0])], [np.array([[T], [X]])]
+
+            # Ramp up to max_temp, then hold
+            while t0 < tf and X < 1.0:
+                dT = heating if T < max_temp else 0.0
+
+                def f(t, y):
+                    # Solver stages may still probe past the switches
+                    dX = self.conversion_lookup(min(y[0], max_temp), y[1]) if y[1] < 1.0 else 0.0
+                    return np.array([dT, dX])
+
+                def reached_max_temp(t, y):
+                    return y[0] - max_temp
+                reached_max_temp.terminal = True
+
+                if implicit:
+                    def jac(t, y):
+                        return np.array([[0.0, 0.0], self.rate_jacobian(min(y[0], max_temp), y[1]) if y[1] < 1.0 else [0.0, 0.0]])
+                    solver_kwargs['jac'] = jac
+
+                events = [full_conversion, reached_max_temp] if dT > 0 else [full_conversion]
+                sol = solve_ivp(f, [t0, tf], [T, X], method=method, events=events, **solver_kwargs)
+                ts.append(sol.t[1:])
+                ys.append(sol.y[:,1:])
+                t0, T, X = sol.t[-1], sol.y[0,-1], sol.y[1,-1]
+                if sol.status != 1:
+                    break
+
+                # Snap the state onto the switch that ended the integration
+                if sol.t_events[0].size > 0:
+                    X = 1.0
+                else:
+                    T = max_temp
+                ys[-1][:,-1] = [T, X]
+
+            # Temperature keeps ramping after full conversion
+            if t0 < tf and X >= 1.0:
+                t_rest = [tf]
+                if T < max_temp and t0 + (max_temp - T) / heating < tf:
+                    t_rest = [t0 + (max_temp - T) / heating, tf]
+                t_rest = np.array(t_rest)
+                ts.append(t_rest)
+                ys.append(np.vstack([np.minimum(T + heating*(t_rest - t0), max(T, max_temp)), np.ones(t_rest.size)]))
+
+            return np.concatenate(ts), np.hstack(ys)
+
         else:
-            times = None
-        sol = solve_ivp(f, tspan, y0, t_eval=times)
+            f = self.get_sim_func(heating)
+            if implicit:
+                def jac(t, y):
+                    if y[0] >= 1.0:
+                        return np.zeros((1, 1))
+                    return np.array([[self.rate_jacobian(np.interp(t, heating[0], heating[1]), y[0])[1]]])
+                solver_kwargs['jac'] = jac
+
+            if breakpoints is None:
+                breakpoints = self.heating_breakpoints(heating[0], heating[1])
+            breakpoints = np.asarray(breakpoints, dtype=float)
+            edges = np.unique(np.concatenate([[t0], breakpoints[(breakpoints > t0) & (breakpoints < tf)], [tf]]))
+
+            times = np.asarray(heating[0])
+            times = times[(times >= t0) & (times <= tf)]
+            X = float(np.ravel(y0)[0])
+
+            # Each segment starts with the last accepted step of the previous one, so the solver does 
+            # not pay for the initial step selection again
+            solver_kwargs = dict(solver_kwargs, dense_output=True)
+            first_step = solver_kwargs.pop('first_step', None)
+
+            ts, ys = [], []
+            for a, b in zip(edges[:-1], edges[1:]):
+                seg = times[(times >= a) & ((times < b) | (b == tf))]
+                Xs = np.ones(seg.size)
+                if X < 1.0:
+                    # Evaluate at b as well to carry the state into the next segment
+                    step = None if first_step is None else min(first_step, b - a)
+                    sol = solve_ivp(f, [a, b], [X], method=method, t_eval=np.union1d(seg, [b]), 
+                                    events=full_conversion, first_step=step, **solver_kwargs)
+                    # The last step is cut short at b, so take the larger of the last two
+                    if sol.sol is not None and sol.sol.ts.size > 1:
+                        first_step = np.amax(np.diff(sol.sol.ts)[-2:])
+                    n = min(sol.t.size, seg.size)
+                    Xs[:n] = sol.y[0,:n]
+                    if sol.status == -1:
+                        ts.append(seg[:n])
+                        ys.append(Xs[:n])
+                        break
+                    X = 1.0 if sol.status == 1 else sol.y[0,-1]
+                ts.append(seg)
+                ys.append(Xs)
+
+            return np.concatenate(ts), np.expand_dims(np.concatenate(ys), 0)
+
+
+    def heating_breakpoints(self, Time, Temp, kink_tol = 0.1):
+        '''
+        Times at which a piecewise linear heating program changes heating rate
+
+        Inputs:
+            Time - time points of the heating program
+            Temp - temperatures at the time points
+            kink_tol - smallest change in heating rate treated as a breakpoint. Units in C/min. 
+
+        Returns:
+            breakpoints - array of times at kinks of the heating program
+
+        '''
 
-        return sol.t, sol.y
+        slopes = np.diff(Temp) / np.diff(Time)
+        breakpoints = np.asarray(Time)[1:-1][np.abs(np.diff(slopes)) > kink_tol]
+
+        # Measured temperatures kink almost everywhere, leave those to the step size control
+        if breakpoints.size > 0.1*np.size(Time):
+            return np.array([])
+
+        return breakpoints
+
+
+    def rate_jacobian(self, T, O2conv):
+        '''
+        Partial derivatives of the conversion rate with respect to temperature and conversion by central 
+            differences of conversion_lookup. Used as the Jacobian for implicit solvers. 
+
+        Returns:
+            dT - derivative of the rate with respect to temperature
+            dX - derivative of the rate with respect to conversion
+
+        '''
+
+        hT, hX = 1e-2, 1e-5
+        r = self.conversion_lookup(np.array([T + hT, T - hT, T, T]), 
+                                   np.array([O2conv, O2conv, O2conv + hX, O2conv - hX]))
+
+        return (r[0] - r[1]) / 2 / hT, (r[2] - r[3]) / 2 / hX
+
+
+    def simulate_rto_batch(self, y0s, tspan, heatings, max_temp=750, **solver_kwargs):
+        '''
+        Simulate many heating programs at once. All experiments are integrated as one stacked state 
+            vector, so conversion_lookup is called once per solver step with the (T, X) points of 
+            all experiments. 
+
+        Inputs:
+            y0s - list of initial conditions, one per heating program, as for simulate_rto
+            tspan - time span shared by all simulations
+            heatings - list of heating programs, each either a linear heating rate (scalar value) or 
+                list of form [Time, Temps]
+            max_temp - maximum temperature, scalar or one value per heating program
+            solver_kwargs - passed on to solve_ivp. Step sizes are shared by all experiments, so 
+                tolerances apply to the stacked state. 
+
+        Returns:
+            results - list of (t, y) for each heating program in the same form as simulate_rto
+
+        '''
+
+        n = len(heatings)
+        ramps = [i for i in range(n) if np.isscalar(heatings[i])]
+        schedules = [i for i in range(n) if not np.isscalar(heatings[i])]
+        n_ramps = len(ramps)
+        rates = np.array([heatings[i] for i in ramps], dtype=float)
+        max_temps = np.broadcast_to(np.asarray(max_temp, dtype=float), (n,))[ramps]
+
+        # State vector: temperatures of the linear ramps, then conversions of all heating programs
+        y0 = np.concatenate([[y0s[i][0] for i in ramps], [y0s[i][-1] for i in range(n)]]).astype(float)
+
+        def f(t, y):
+            T = np.empty(n)
+            T[ramps] = y[:n_ramps]
+            for i in schedules:
+                T[i] = np.interp(t, heatings[i][0], heatings[i][1])
+            X = y[n_ramps:]
+
+            dT = np.where(y[:n_ramps] < max_temps, rates, 0.0)
+            dX = np.zeros(n)
+            active = X < 1.0
+            if np.any(active):
+                dX[active] = self.conversion_lookup(T[active], X[active])
+
+            return np.concatenate([dT, dX])
+
+        sol = solve_ivp(f, tspan, y0, dense_output=len(schedules) > 0, **solver_kwargs)
+
+        results = []
+        for i in range(n):
+            if np.isscalar(heatings[i]):
+                results.append((sol.t, sol.y[[ramps.index(i), n_ramps + i],:]))
+            else:
+                results.append((heatings[i][0], sol.sol(heatings[i][0])[[n_ramps + i],:]))
+
+        return results
+
+
+    def simulate_rto_ramps(self, y0, tspan, betas, max_temp=750, **solver_kwargs):
+        '''
+        Simulate a sweep of linear heating rates in one vectorized pass. For a constant heating rate 
+            beta the system reduces to dX/dT = r(T, X)/beta up to max_temp followed by an isothermal 
+            tail, so all heating rates share one integration in temperature and one in time. 
+
+        Inputs:
+            y0 - initial condition [Temp, O2 conversion] shared by all heating rates
+            tspan - time span of the simulations
+            betas - linear heating rates
+            max_temp - maximum temperature
+            solver_kwargs - passed on to solve_ivp
+
+        Returns:
+            results - list of (t, y) for each heating rate in the same form as simulate_rto
+
+        '''
+
+        betas = np.atleast_1d(np.asarray(betas, dtype=float))
+        T0, X0 = float(y0[0]), float(y0[1])
+        t0, tf = tspan
+
+        # Temperature held after the ramp and temperature reached by each ramp at the end of tspan
+        T_hold = max(max_temp, T0)
+        T_end = np.minimum(T_hold, T0 + betas*(tf - t0))
+        t_ramp = (T_end - T0) / betas
+
+        def rhs(T, X, scale):
+            dX = np.zeros_like(X)
+            active = X < 1.0
+            if np.any(active):
+                dX[active] = self.conversion_lookup(np.full(np.sum(active), T), X[active]) / scale[active]
+            return dX
+
+        # Ramp phase in temperature domain
+        ramp_T, ramp_X = [np.array([T0])]*betas.size, [np.array([X0])]*betas.size
+        if np.amax(T_end) > T0:
+            sol = solve_ivp(lambda T, X: rhs(T, X, betas), [T0, np.amax(T_end)], np.full(betas.size, X0), 
+                dense_output=True, **solver_kwargs)
+            for i in range(betas.size):
+                if T_end[i] > T0:
+                    ramp_T[i] = np.append(sol.t[sol.t < T_end[i]], T_end[i])
+                    ramp_X[i] = sol.sol(ramp_T[i])[i]
+
+        # Isothermal tail in time since the end of each ramp
+        s_end = np.where(T_end >= T_hold, tf - t0 - t_ramp, 0.0)
+        tails = np.nonzero(s_end > 0)[0]
+        if tails.size > 0:
+            X_start = np.array([ramp_X[i][-1] for i in tails])
+            sol = solve_ivp(lambda s, X: rhs(T_hold, X, np.ones_like(X)), [0, np.amax(s_end)], X_start, 
+                dense_output=True, **solver_kwargs)
+
+        results = []
+        for i in range(betas.size):
+            t = t0 + (ramp_T[i] - T0) / betas[i]
+            T, X = ramp_T[i], ramp_X[i]
+            if s_end[i] > 0:
+                s = np.append(sol.t[(sol.t > 0) & (sol.t < s_end[i])], s_end[i])
+                t = np.concatenate([t, t0 + t_ramp[i] + s])
+                T = np.concatenate([T, np.full(s.size, T_hold)])
+                X = np.concatenate([X, sol.sol(s)[np.searchsorted(tails, i)]])
+            results.append((t, np.vstack([T, X])))
+
+        return results
 
 
     def print_rto_experiment(self, y0, tspan, heating, title=None, max_temp=750, save_path = None):
@@ -412,124 +1930,457 @@ class NonArrheniusInterp(NonArrheniusBase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        # Build interpolation surface
-        T_MAX = np.amax(self.Temps)
-        def lookup_surface1(Tq, O2q):
-            data = griddata((self.Temps.flatten()/T_MAX, self.O2convs.flatten()), 
-                            self.dXdt.flatten(), (Tq/T_MAX, O2q), method='linear')
-            return data
+        kwargs.setdefault('engine', 'delaunay')
+
+        if kwargs['engine'] not in ['delaunay', 'curves']:
+            raise Exception('Invalid interpolation engine {} entered.'.format(kwargs['engine']))
+        self.engine = kwargs['engine']
+
+        self.build_lookup_surfaces()
+
+
+    def build_lookup_surfaces(self):
+        '''
+        Build the structures used by conversion_lookup. They are built once here and reused by 
+            every query. They hold only arrays, so a fitted model can be pickled and sent to other 
+            processes without rebuilding them. 
 
-        self.interp_surface = lookup_surface1
+        Engines:
+            'delaunay' - triangulation of all training points for linear interpolation and 
+                nearest-neighbour tree over a fine grid for extrapolation
+            'curves' - each heating rate curve indexed by conversion (see curve_lookup)
+
+        '''
+
+        self.T_MAX = np.amax(self.Temps)
+
+        if self.engine == 'curves':
+            self.build_curve_index()
+            self.build_extrap_tree()
+            return
+
+        # Build interpolation surface
+        points = np.column_stack([self.Temps.flatten()/self.T_MAX, self.O2convs.flatten()])
+        self.triangulation = Delaunay(points)
+        self.interpolator = LinearNDInterpolator(self.triangulation, self.dXdt.flatten())
 
         # Build extrapolation surface
         fine_T, fine_O2conv = np.mgrid[20:750:200j, 0:1:200j]
-        fine_dO2 = self.interp_surface(fine_T, fine_O2conv)
+        self.fine_dO2 = self.interp_surface(fine_T, fine_O2conv)
+        self.build_extrap_tree()
 
-        def lookup_surface2(Tq, O2q):
-            data = griddata((fine_T[np.isfinite(fine_dO2)]/T_MAX, fine_O2conv[np.isfinite(fine_dO2)]), 
-                            fine_dO2[np.isfinite(fine_dO2)], (Tq/T_MAX, O2q), method='nearest')
-            return data
-    
-        self.extrap_surface = lookup_surface2
 
-    
-    def conversion_lookup(self, T, O2conv):
+    def build_extrap_tree(self):
+        '''
+        Nearest-neighbour tree over the finite part of the fine interpolation grid fine_dO2 or, for 
+            the curves engine, over the points of the curve index
+        '''
+        if self.engine == 'curves':
+            O2conv = self.curve_keys - 2.0*np.floor(self.curve_keys / 2.0) # undo the shift of each curve
+            self.extrap_tree = cKDTree(np.column_stack([self.curve_Temps/self.T_MAX, O2conv]))
+            self.extrap_dO2 = self.curve_dXdt
+            return
+
+        fine_T, fine_O2conv = np.mgrid[20:750:200j, 0:1:200j]
+        finite = np.isfinite(self.fine_dO2)
+        self.extrap_tree = cKDTree(np.column_stack([fine_T[finite]/self.T_MAX, fine_O2conv[finite]]))
+        self.extrap_dO2 = self.fine_dO2[finite]
 
-        dO2conv = self.interp_surface(T, O2conv)
 
-        if np.isscalar(T):
-            if np.isnan(dO2conv):
-                dO2conv = self.extrap_surface(T, O2conv)
+    def add_training_rows(self, start, count):
+        '''
+        Add new training points to the lookup structures. Adding points to a Delaunay triangulation 
+            only replaces triangles whose circumcircle contains a new point by triangles with a new 
+            point as a vertex, so only fine grid points inside triangles with a new vertex are 
+            interpolated again. The triangulation itself is redone by qhull, which is fast, since an 
+            incremental qhull triangulation cannot be pickled. Curves are inserted into the curve 
+            index. New temperatures above the current maximum change the normalization, then 
+            everything is rebuilt. 
+
+        '''
+
+        new = slice(start, start + count)
+        Tn, O2n, dXn = np.ravel(self.Temps)[new], np.ravel(self.O2convs)[new], np.ravel(self.dXdt)[new]
+
+        if np.amax(Tn) > self.T_MAX:
+            self.build_lookup_surfaces()
+
+        elif self.engine == 'curves':
+            # Shift the keys of the curves after the new one, it is curve start // interpnum
+            pos = start // self.interpnum
+            keys, Temps, dXdt = self.index_curve(O2n, Tn, dXn)
+            after = self.curve_keys >= 2.0*pos
+            self.curve_keys = np.concatenate([self.curve_keys[~after], keys + 2.0*pos, self.curve_keys[after] + 2.0])
+            self.curve_Temps = np.concatenate([self.curve_Temps[~after], Temps, self.curve_Temps[after]])
+            self.curve_dXdt = np.concatenate([self.curve_dXdt[~after], dXdt, self.curve_dXdt[after]])
+            self.build_extrap_tree()
+
+        else:
+            points = np.column_stack([self.Temps.flatten()/self.T_MAX, self.O2convs.flatten()])
+            self.triangulation = Delaunay(points)
+            self.interpolator = LinearNDInterpolator(self.triangulation, self.dXdt.flatten())
+
+            fine_T, fine_O2conv = np.mgrid[20:750:200j, 0:1:200j]
+            simplex = self.triangulation.find_simplex(np.column_stack([fine_T.flatten()/self.T_MAX, fine_O2conv.flatten()]))
+            vertices = self.triangulation.simplices[simplex]
+            changed = np.reshape((simplex >= 0) & np.any((vertices >= start) & (vertices < start + count), axis=1), fine_T.shape)
+            self.fine_dO2 = self.fine_dO2.copy()
+            self.fine_dO2[changed] = self.interp_surface(fine_T[changed], fine_O2conv[changed])
+            self.build_extrap_tree()
+
+        super().add_training_rows(start, count)
+
+
+    def save_state(self):
+        params, arrays = super().save_state()
+        params.update({'engine': self.engine, 'T_MAX': self.T_MAX})
+
+        if self.engine == 'curves':
+            arrays.update({'curve_keys': self.curve_keys, 'curve_Temps': self.curve_Temps, 'curve_dXdt': self.curve_dXdt})
         else:
-            dO2conv[np.isnan(dO2conv)] = self.extrap_surface(T[np.isnan(dO2conv)], O2conv[np.isnan(dO2conv)])
+            arrays.update({'fine_dO2': self.fine_dO2})
+
+        return params, arrays
+
+
+    def load_state(self, params, arrays):
+        super().load_state(params, arrays)
+        self.engine = params['engine']
+        self.T_MAX = params['T_MAX']
+
+        if self.engine == 'curves':
+            self.curve_keys, self.curve_Temps, self.curve_dXdt = arrays['curve_keys'], arrays['curve_Temps'], arrays['curve_dXdt']
+            self.build_extrap_tree()
+            return
+
+        # Rebuild the triangulation and tree, the saved extrapolation grid skips the fine grid evaluation
+        points = np.column_stack([self.Temps.flatten()/self.T_MAX, self.O2convs.flatten()])
+        self.triangulation = Delaunay(points)
+        self.interpolator = LinearNDInterpolator(self.triangulation, self.dXdt.flatten())
+        self.fine_dO2 = arrays['fine_dO2']
+        self.build_extrap_tree()
+
+
+    def interp_surface(self, Tq, O2q):
+        '''
+        Linear interpolation over the training data, NaN outside of the convex hull
+        '''
+        return self.interpolator(np.asarray(Tq)/self.T_MAX, O2q)
+
+
+    def extrap_surface(self, Tq, O2q):
+        '''
+        Nearest-neighbour lookup on the finite part of the fine interpolation grid
+        '''
+        Tq, O2q = np.broadcast_arrays(np.asarray(Tq, dtype=float), np.asarray(O2q, dtype=float))
+        _, inds = self.extrap_tree.query(np.stack([Tq/self.T_MAX, O2q], axis=-1))
+        return self.extrap_dO2[inds]
+
+    
+    def build_curve_index(self):
+        '''
+        Index each heating rate curve by conversion (see index_curve). Curve i is shifted by 2*i 
+            along the conversion axis so all curves are searched with a single np.interp call. 
+
+        '''
+        keys, Temps, dXdt = [], [], []
+
+        for i in range(len(self.heating_rates)):
+            curve = self.index_curve(self.O2convs[i], self.Temps[i], self.dXdt[i])
+            keys.append(curve[0] + 2.0*i)
+            Temps.append(curve[1])
+            dXdt.append(curve[2])
+
+        self.curve_keys = np.concatenate(keys)
+        self.curve_Temps = np.concatenate(Temps)
+        self.curve_dXdt = np.concatenate(dXdt)
+
+
+    def index_curve(self, O2conv, Temp, dXdt):
+        '''
+        Samples of one heating rate curve kept in the curve index. Conversion is non-decreasing along 
+            a curve, so flat runs (before ignition and after burnout) are collapsed to their last 
+            sample, which leaves a strictly increasing conversion axis for binary search. 
+
+            The pre-ignition run collapses to the ignition temperature with a rate of about zero, and 
+            a simulation starting from X = 0 would never ignite. X = 0 keeps the ignition temperature 
+            but takes its rate from the ignition side, the first sample with X > 0. 
+
+        Returns:
+            O2conv, Temp, dXdt - conversion, temperature and rate of the kept samples
+
+        '''
+
+        # np.unique keeps the first occurrence, so search the reversed curve to keep the last
+        _, inds = np.unique(O2conv[::-1], return_index=True)
+        inds = O2conv.shape[0] - 1 - inds
+
+        rates = dXdt[inds]
+        if inds.shape[0] > 1 and O2conv[inds[0]] <= 0.0:
+            rates[0] = rates[1]
+
+        return O2conv[inds], Temp[inds], rates
+
+
+    def curve_lookup(self, Tq, O2q):
+        '''
+        Lookup conversion rate using the curve structure of the training data. For each heating 
+            rate curve, the temperature and rate at conversion O2q are found by binary search. The 
+            query is then interpolated linearly in temperature between the two neighbouring curves. 
+            Below the slowest curve the rate decays to the 20C boundary condition (zero rate), above 
+            the fastest curve the nearest point of the curve index is used (see build_extrap_tree), 
+            and the rate is zero at full conversion. 
+
+        Inputs:
+            Tq - 1D array of temperature values
+            O2q - 1D array of O2 conversion values
+
+        Returns:
+            dO2conv - 1D array of O2 conversion rate values
+
+        '''
+        
+        BC_TEMP = 20.0
+        O2q = np.clip(O2q, 0.0, 1.0)
+
+        # Temperature and rate of each curve at the query conversions, plus the left BC curve
+        keys = O2q + 2.0*np.arange(len(self.heating_rates))[:,None] # H x N
+        Tc = np.vstack([BC_TEMP*np.ones_like(O2q), np.interp(keys, self.curve_keys, self.curve_Temps)]) # H+1 x N
+        rc = np.vstack([np.zeros_like(O2q), np.interp(keys, self.curve_keys, self.curve_dXdt)]) # H+1 x N
+        
+        # Curves are sorted by heating rate, so guard against noisy crossings before searching
+        Tc = np.maximum.accumulate(Tc, axis=0)
+        
+        # Locate bracketing curves and interpolate linearly in temperature
+        upper = np.clip(np.sum(Tc <= Tq, axis=0), 1, Tc.shape[0] - 1)
+        cols = np.arange(Tq.shape[0])
+        T_lo, T_hi = Tc[upper-1, cols], Tc[upper, cols]
+        r_lo, r_hi = rc[upper-1, cols], rc[upper, cols]
+        dT = T_hi - T_lo
+        w = np.clip(np.divide(Tq - T_lo, dT, out=np.ones_like(dT), where=dT > 0), 0.0, 1.0)
+        dO2conv = (1 - w)*r_lo + w*r_hi
+
+        # Holding the rate of the fastest curve would stall ignition, extrapolate from the nearest point
+        above = Tq > Tc[-1]
+        if np.any(above):
+            _, inds = self.extrap_tree.query(np.column_stack([Tq[above]/self.T_MAX, O2q[above]]))
+            dO2conv[above] = self.extrap_dO2[inds]
+
+        dO2conv[Tq <= BC_TEMP] = 0.0
+        dO2conv[O2q >= 1.0] = 0.0
 
         return dO2conv
 
 
+    def lookup_state(self):
+        return super().lookup_state() + (self.engine,)
+
+
+    def exact_lookup(self, T, O2conv):
+
+        Tq, O2q = np.broadcast_arrays(np.asarray(T, dtype=float), np.asarray(O2conv, dtype=float))
+
+        if self.engine == 'curves':
+            dO2conv = self.curve_lookup(Tq.flatten(), O2q.flatten())
+
+        else:
+            xq = np.column_stack([Tq.flatten()/self.T_MAX, O2q.flatten()])
+
+            # Interpolate all points, then fill points outside of the hull from the extrapolation tree
+            dO2conv = self.interpolator(xq)
+            nan_inds = np.isnan(dO2conv)
+            if np.any(nan_inds):
+                _, inds = self.extrap_tree.query(xq[nan_inds])
+                dO2conv[nan_inds] = self.extrap_dO2[inds]
+
+        if np.isscalar(T):
+            return dO2conv[0]
+
+        return np.reshape(dO2conv, Tq.shape)
+
+
 class NonArrheniusML(NonArrheniusBase):
 
+    # Number of training points per block in moment_rate_and_var
+    MOMENT_BLOCK = 256
+
+
+    # Index of each entry of the 3x3 moment matrix in the 6 unique moments (1, t, o, t^2, t*o, o^2)
+    SYM = np.array([[3,4,1], [4,5,2], [1,2,0]])
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         kwargs.setdefault('constrained', True)
-
-        self.tau = 0.12
+        kwargs.setdefault('cutoff', None)
+        kwargs.setdefault('max_memory', None)
+        kwargs.setdefault('n_threads', 1)
+        kwargs.setdefault('sigma_samples', None)
+        kwargs.setdefault('random_state', None)
+        kwargs.setdefault('tau', 0.12)
+        kwargs.setdefault('tau_grid', None)
+        kwargs.setdefault('tau_score', 'loo')
 
         self.constrained = kwargs['constrained']
+        self.max_memory = kwargs['max_memory']
+        self.n_threads = kwargs['n_threads']
+        self.sigma_samples = kwargs['sigma_samples']
+
+        # Compact-support kernel, see truncated_rate_and_var
+        if kwargs['cutoff'] is not None and not kwargs['cutoff'] >= np.sqrt(2):
+            raise Exception('Invalid cutoff {} entered, it must be at least sqrt(2).'.format(kwargs['cutoff']))
+        self.cutoff = kwargs['cutoff']
+
+        self.prepare_design()
+
+        # Kernel bandwidth, fixed or selected by cross-validation (see select_tau)
+        self.tau_grid, self.tau_scores, self.tau_score = None, None, None
+        if isinstance(kwargs['tau'], str) and kwargs['tau'] == 'auto':
+            self.select_tau(kwargs['tau_grid'], kwargs['tau_score'])
+        elif isinstance(kwargs['tau'], str):
+            raise Exception('Invalid tau {} entered.'.format(kwargs['tau']))
+        else:
+            self.tau = kwargs['tau']
         
         ##### Compute estimate of variance
-        Temps_norm = self.Temps / np.amax(self.Temps)
-        X = np.expand_dims(np.column_stack([Temps_norm.flatten(), self.O2convs.flatten(), np.ones_like(self.O2convs.flatten())]), 0) #1 x M x 3
-        xq = np.squeeze(X)
-        W = np.exp(-np.sum((np.transpose(X,axes=(0,2,1)) - np.expand_dims(xq,2))**2, 
-                            axis=1, keepdims=True) / self.tau**2 / 2) # N x 1 x M
-        XTW = np.transpose(X, axes=(0,2,1))*W # N x 3 x M
+        self.estimate_sigma(samples=kwargs['sigma_samples'], random_state=kwargs['random_state'])
 
-        L = np.squeeze(np.matmul(np.expand_dims(xq,1), np.linalg.solve(np.matmul(XTW, X), XTW)))
-        Lbar = np.eye(L.shape[0]) - L
         
-        self.delta1 = np.trace(np.matmul(Lbar.T, Lbar))
-        yhat =  self.conversion_lookup(self.Temps, self.O2convs).flatten()
-        epshat = self.dXdt.flatten() - yhat
-        self.sigma = np.sqrt(np.sum(epshat**2) / self.delta1)
+    def prepare_design(self):
+        '''
+        Precompute the normalized design, targets and moment features of the training data as 
+            contiguous arrays, so rate lookups do not rebuild them on every call. Must be called again 
+            whenever the training arrays change. 
 
-        
-    def conversion_lookup(self, T, O2conv, tau = None):
         '''
-        Short wrapper to retrieve reaction rate
+
+        self.T_SCALE = np.amax(self.Temps)
+
+        # Normalized (T, O2conv) of each training point, one contiguous row per coordinate
+        self.design = np.ascontiguousarray(np.vstack([self.Temps.flatten() / self.T_SCALE, self.O2convs.flatten()])) # 2 x M
+        self.y = np.ascontiguousarray(self.dXdt.flatten()) # M
+
+        self.features, self.features_y = self.moment_features(self.design, self.y)
+
+        self.tree = cKDTree(self.design.T)
+
+
+    def moment_features(self, design, y):
+        '''
+        Unique entries of the symmetric x*x^T for x = (t, o, 1): 1, t, o, t^2, t*o, o^2 (M x 6), and 
+            x*y (M x 3) of normalized design points (2 x M) with targets y
+        '''
+        t, o = design
+        features = np.column_stack([np.ones_like(t), t, o, t**2, t*o, o**2]) # M x 6
+        return features, features[:,[1,2,0]]*y[:,None]
+
+
+    def lookup_state(self):
+        return super().lookup_state() + (self.tau, self.constrained, self.cutoff)
+
+
+    def save_state(self):
+        params, arrays = super().save_state()
+        params.update({'tau': self.tau, 'constrained': self.constrained, 'cutoff': self.cutoff, 
+                       'max_memory': self.max_memory, 'n_threads': self.n_threads, 
+                       'sigma': self.sigma, 'delta1': self.delta1, 'T_SCALE': self.T_SCALE, 
+                       'tau_score': self.tau_score})
+        arrays.update({'design': self.design, 'y': self.y, 'features': self.features, 'features_y': self.features_y})
+        if self.tau_score is not None:
+            arrays.update({'tau_grid': self.tau_grid, 'tau_scores': self.tau_scores})
+
+        # Per-row sigma terms, so loaded models can add experiments without estimating sigma again
+        params.update({'sigma_samples': self.sigma_samples, 'sigma_stats_tau': self.sigma_stats['tau']})
+        arrays.update({'sigma_' + name: self.sigma_stats[name] for name in ['rows', 'weights', 'sq_resid', 'trace_terms', 'moments', 'fallback', 'truncated'] 
+                       if self.sigma_stats[name] is not None})
+        return params, arrays
+
+
+    def load_state(self, params, arrays):
+        super().load_state(params, arrays)
+        for name in ['tau', 'constrained', 'cutoff', 'max_memory', 'n_threads', 'sigma', 'delta1', 'T_SCALE', 'tau_score']:
+            setattr(self, name, params[name])
+        self.tau_grid, self.tau_scores = arrays.get('tau_grid'), arrays.get('tau_scores')
+        self.sigma_samples = params['sigma_samples']
+        self.sigma_stats = {name: arrays.get('sigma_' + name) for name in ['rows', 'weights', 'sq_resid', 'trace_terms', 'moments', 'fallback', 'truncated']}
+        self.sigma_stats['tau'] = params['sigma_stats_tau']
+        self.design, self.y, self.features, self.features_y = arrays['design'], arrays['y'], arrays['features'], arrays['features_y']
+
+        # Sigma is restored as saved, only the KD-tree is rebuilt
+        self.tree = cKDTree(self.design.T)
+
+
+    def conversion_lookup(self, T, O2conv, tau = None, **kwargs):
+        '''
+        Short wrapper to retrieve reaction rate. A custom tau bypasses the rate table and 
+            memoization cache. 
+        '''
+        if tau is not None:
+            return self.exact_lookup(T, O2conv, tau = tau, **kwargs)
+
+        return super().conversion_lookup(T, O2conv, **kwargs)
+
+
+    def exact_lookup(self, T, O2conv, tau = None, chunk_size = None, max_memory = None, n_threads = None):
         '''
-        dX, _ = self.get_rate_and_var(T, O2conv, compute_var=False, tau = tau)
+        Reaction rate from the local linear fit, see get_rate_and_var
+        '''
+        dX, _ = self.get_rate_and_var(T, O2conv, compute_var=False, tau = tau, 
+                                        chunk_size = chunk_size, max_memory = max_memory, n_threads = n_threads)
         return dX
 
 
-    def get_rate_and_var(self, T, O2conv, compute_var = True, tau = None):
+    def get_rate_and_var(self, T, O2conv, compute_var = True, tau = None, chunk_size = None, max_memory = None, 
+                            n_threads = None):
         '''
         Calculate convsersion rate and variance at each point in input arrays T and O2conv
+
+        Inputs:
+            T - temperature or array-like of temperature values
+            O2conv - O2 conversion or array-like of O2 conversion values
+            compute_var - whether to compute the standard deviation of the estimate
+            tau - kernel bandwidth, defaults to self.tau
+            chunk_size - number of query points evaluated at once
+            max_memory - approximate peak memory in bytes for the evaluation, used to pick chunk_size 
+                if it is not given. Defaults to the max_memory passed to the constructor. 
+            n_threads - number of threads the chunks are split across. Defaults to the n_threads 
+                passed to the constructor. Results do not depend on the number of threads. 
+
+        Returns:
+            dX - conversion rate values
+            sigmas - standard deviations of the rate estimates (None if compute_var is False)
         
         '''
 
         if tau is None:
             tau = self.tau
 
-        T_norm = T / np.amax(self.Temps)
-        Temps_norm = self.Temps / np.amax(self.Temps)
+        T_norm = T / self.T_SCALE
 
         sigmas = None
 
-        # Non-vectorized operation for scalar input
-        if np.isscalar(T):
-            if not np.isscalar(O2conv):
-                O2conv = np.asscalar(O2conv)
-
-            xq = np.expand_dims(np.array([T_norm, O2conv, 1.0]),0)
-            X = np.column_stack([Temps_norm.flatten(), self.O2convs.flatten(), np.ones_like(self.O2convs.flatten())])
-            y = self.dXdt.flatten()
-            W = np.exp(-np.sum((X - xq)**2, axis=1, keepdims=True) / tau**2 / 2)
-            XTW = np.transpose(X*W)
-
-            L = np.dot(np.squeeze(xq), np.linalg.solve(np.matmul(XTW, X), XTW))
-            dX = np.dot(L, y)
-
+        # Scalar fast path for ODE right-hand sides
+        if np.isscalar(T) and self.cutoff is None:
+            dX, sumL2 = self.scalar_rate_and_var(T_norm, np.asarray(O2conv).item(), tau, compute_var)
             if compute_var:
-                sigmas = self.sigma*np.sqrt(np.sum(L**2))
+                sigmas = self.sigma*np.sqrt(sumL2)
 
-        # Vectorized version for array inputs
+        # Vectorized version for array inputs, streamed through in chunks of query points
         else:
-            xq = np.column_stack([T_norm.flatten(), O2conv.flatten(), np.ones_like(O2conv.flatten())]) # N x 3
-            X = np.expand_dims(np.column_stack([Temps_norm.flatten(), self.O2convs.flatten(), np.ones_like(self.O2convs.flatten())]), 0) #1 x M x 3
-            y = self.dXdt.flatten() # M 
-            W = np.exp(-np.sum((np.transpose(X,axes=(0,2,1)) - np.expand_dims(xq,2))**2, 
-                                axis=1, keepdims=True) / tau**2 / 2) # N x 1 x M
-            XTW = np.transpose(X, axes=(0,2,1))*W # N x 3 x M
-
-            L = np.squeeze(np.matmul(np.expand_dims(xq,1), np.linalg.solve(np.matmul(XTW, X), XTW)))
-            dX = np.matmul(L, y)
-
-            dX = np.reshape(dX, T.shape)
+            xq = np.column_stack([np.ravel(T_norm), np.ravel(O2conv), np.ones(np.size(T_norm))]) # N x 3
 
+            dX, sumL2, _ = self.evaluate_kernel(xq, tau, compute_var, chunk_size, max_memory, n_threads)
             if compute_var:
-                sigmas = self.sigma*np.sqrt(np.sum(L**2, axis=1))
-                sigmas = np.reshape(sigmas, T.shape)
+                sigmas = self.sigma*np.sqrt(sumL2)
+
+            if np.isscalar(T):
+                dX = dX[0]
+                if compute_var:
+                    sigmas = sigmas[0]
+            else:
+                dX = np.reshape(dX, np.shape(T))
+                if compute_var:
+                    sigmas = np.reshape(sigmas, np.shape(T))
 
 
         # Implement constrained model
@@ -546,6 +2397,528 @@ class NonArrheniusML(NonArrheniusBase):
         return dX, sigmas
 
 
+    def evaluate_kernel(self, xq, tau, compute_var = True, chunk_size = None, max_memory = None, n_threads = None, 
+                        return_moments = False):
+        '''
+        Evaluate the local linear fit at query points xq (N x 3 rows of [T_norm, O2conv, 1]), streamed 
+            through in chunks of query points and optionally split across threads. 
+
+        Returns:
+            dX - unconstrained rate at each query
+            sumL2 - sum of squared hat matrix entries sum_j L_qj^2 of each query (None if compute_var 
+                is False)
+            Lqq - weight L_qq the fit gives to a training point located at the query, which is the 
+                diagonal of L when the queries are the training points
+            moments, fallback - only if return_moments is True, the moments S, Sy and S2 each query 
+                was solved with (N x 15, see kernel_moments) and, with a cutoff, whether it used the 
+                full kernel (None without a cutoff)
+
+        '''
+
+        # Kernel truncated to the neighbourhood of each query, or moments over all points
+        kernel = self.moment_rate_and_var if self.cutoff is None else self.truncated_rate_and_var
+
+        N = xq.shape[0]
+        if n_threads is None:
+            n_threads = self.n_threads
+        chunk_size = min(self.query_chunk_size(chunk_size, max_memory, n_threads), -(-N // n_threads))
+
+        dX, Lqq = np.empty(N), np.empty(N)
+        sumL2 = np.empty(N) if compute_var else None
+        moments = np.empty((N, 15)) if return_moments else None
+        fallback = np.empty(N, dtype=bool) if return_moments and self.cutoff is not None else None
+
+        def eval_chunk(i):
+            chunk = slice(i, i + chunk_size)
+            if return_moments and self.cutoff is not None:
+                dX[chunk], sumL2_chunk, Lqq[chunk], moments[chunk], fallback[chunk] = kernel(xq[chunk], tau, compute_var, return_moments=True)
+            elif return_moments:
+                S, Sy, S2 = self.kernel_moments(xq[chunk], tau, compute_var)
+                dX[chunk], sumL2_chunk, Lqq[chunk] = self.moment_solve(S, Sy, S2, compute_var)
+                moments[chunk] = np.column_stack([S, Sy, S2])
+            else:
+                dX[chunk], sumL2_chunk, Lqq[chunk] = kernel(xq[chunk], tau, compute_var)
+            if compute_var:
+                sumL2[chunk] = sumL2_chunk
+
+        # NumPy releases the GIL in the kernels, so chunks run in parallel on threads. Each 
+        # chunk writes to its own slice of the outputs. 
+        if n_threads > 1 and N > chunk_size:
+            with ThreadPoolExecutor(max_workers=n_threads) as executor:
+                list(executor.map(eval_chunk, range(0, N, chunk_size)))
+        else:
+            for i in range(0, N, chunk_size):
+                eval_chunk(i)
+
+        if return_moments:
+            return dX, sumL2, Lqq, moments, fallback
+
+        return dX, sumL2, Lqq
+
+
+    def estimate_sigma(self, samples = None, random_state = None):
+        '''
+        Estimate the noise standard deviation sigma and delta1 = trace((I - L)^T (I - L)) from the 
+            residuals of the fit at the training points. The per-row terms and moments are kept in 
+            sigma_stats for update_sigma. 
+
+        Inputs:
+            samples - if given, estimate from this many randomly chosen rows instead of all M rows
+            random_state - seed or np.random.Generator for the row sample
+
+        '''
+
+        # sigma^2 = sum(epshat^2) / delta1 with delta1 = sum_i (1 - 2*L_ii + sum_j L_ij^2), so each row 
+        # only needs L_ii and sum_j L_ij^2 from its moments. Sampled rows give unbiased estimates of 
+        # both sums. 
+        X = np.column_stack([self.design.T, np.ones_like(self.y)]) # M x 3
+        y = self.y
+        M = X.shape[0]
+
+        rows = np.arange(M)
+        if samples is not None and samples < M:
+            rows = np.sort(np.random.default_rng(random_state).choice(M, size=samples, replace=False))
+
+        yhat, sumL2, Lii, moments, fallback = self.evaluate_kernel(X[rows], self.tau, return_moments=True)
+        truncated = self.truncated_stats(X[rows], moments, fallback)
+        if self.constrained:
+            yhat = np.maximum(yhat, 0)
+        epshat = y[rows] - yhat
+
+        # Scale sampled sums up to all M rows
+        self.delta1 = np.sum(1 - 2*Lii + sumL2) * M / rows.shape[0]
+        self.sigma = np.sqrt(np.sum(epshat**2) * M / rows.shape[0] / self.delta1)
+
+        self.sigma_stats = {'tau': self.tau, 'rows': rows, 'weights': M / rows.shape[0] * np.ones(rows.shape[0]), 
+                            'sq_resid': epshat**2, 'trace_terms': 1 - 2*Lii + sumL2, 'moments': moments, 
+                            'fallback': fallback, 'truncated': truncated}
+
+
+    def truncated_stats(self, X, moments, fallback):
+        '''
+        Truncated moments (N x 15, see truncated_moments) of the rows X used by estimate_sigma, given 
+            the moments and fallback flags from evaluate_kernel, or None without a cutoff
+        '''
+
+        if self.cutoff is None:
+            return None
+
+        truncated = moments.copy()
+        if np.any(fallback):
+            truncated[fallback] = np.column_stack(self.truncated_moments(X[fallback], self.tau, True))
+        return truncated
+
+
+    def update_sigma(self, start, count):
+        '''
+        Update sigma after count training points were inserted at index start of the design. The 
+            new points are added to the kept moments of the rows used by estimate_sigma 
+            (O(rows*count)). With a cutoff, the rows then repeat the truncation test and those that 
+            now need the full kernel are evaluated again. The new rows enter the sums with weight 1. 
+            If tau changed since estimate_sigma, sigma is estimated again from scratch. 
+
+        '''
+
+        stats = self.sigma_stats
+        if stats is None or stats['tau'] != self.tau:
+            self.estimate_sigma(samples=self.sigma_samples)
+            return
+
+        X = np.column_stack([self.design.T, np.ones_like(self.y)]) # M x 3
+        new = slice(start, start + count)
+        rows = stats['rows'] + count*(stats['rows'] >= start)
+        sq_resid, trace_terms, moments, fallback, truncated = [stats[name] for name in ['sq_resid', 'trace_terms', 'moments', 'fallback', 'truncated']]
+
+        def terms(rows, yhat, sumL2, Lii):
+            if self.constrained:
+                yhat = np.maximum(yhat, 0)
+            return (self.y[rows] - yhat)**2, 1 - 2*Lii + sumL2
+
+        # Rows kept from before, the new arrays leave the (possibly memory-mapped) old ones untouched
+        if self.cutoff is None:
+            S, Sy, S2 = self.kernel_moments(X[rows], self.tau, True, points=new)
+            moments = moments + np.column_stack([S, Sy, S2])
+            yhat, sumL2, Lii = self.moment_solve(moments[:,:6], moments[:,6:9], moments[:,9:], True)
+            sq_resid, trace_terms = terms(rows, yhat, sumL2, Lii)
+        else:
+            # Truncated moments add the new points near each row, rows that used the full kernel add 
+            # all of them. The new points change the weight each row drops, so all rows are tested 
+            # again and those that now need the full kernel are evaluated over all points. 
+            truncated = truncated + np.column_stack(self.truncated_moments(X[rows], self.tau, True, points=new))
+            moments = moments.copy()
+            moments[fallback] += np.column_stack(self.kernel_moments(X[rows[fallback]], self.tau, True, points=new))
+            was_fallback, fallback = fallback, self.truncation_fallback(X[rows], self.tau, truncated[:,:6], truncated[:,6:9])
+            moments[~fallback] = truncated[~fallback]
+            redo = fallback & ~was_fallback
+            if np.any(redo):
+                moments[redo] = np.column_stack(self.kernel_moments(X[rows[redo]], self.tau, True))
+            yhat, sumL2, Lii = self.moment_solve(moments[:,:6], moments[:,6:9], moments[:,9:], True)
+            sq_resid, trace_terms = terms(rows, yhat, sumL2, Lii)
+
+        # New rows
+        new_rows = np.arange(start, start + count)
+        yhat, sumL2, Lii, new_moments, new_fallback = self.evaluate_kernel(X[new_rows], self.tau, return_moments=True)
+        if self.cutoff is not None:
+            truncated = np.concatenate([truncated, self.truncated_stats(X[new_rows], new_moments, new_fallback)])
+            fallback = np.concatenate([fallback, new_fallback])
+        moments = np.concatenate([moments, new_moments])
+        new_sq_resid, new_trace_terms = terms(new_rows, yhat, sumL2, Lii)
+
+        self.sigma_stats = {'tau': self.tau, 'rows': np.concatenate([rows, new_rows]), 
+                            'weights': np.concatenate([stats['weights'], np.ones(count)]), 
+                            'sq_resid': np.concatenate([sq_resid, new_sq_resid]), 
+                            'trace_terms': np.concatenate([trace_terms, new_trace_terms]), 'moments': moments, 
+                            'fallback': fallback, 'truncated': truncated}
+
+        weights = self.sigma_stats['weights']
+        self.delta1 = np.sum(weights*self.sigma_stats['trace_terms'])
+        self.sigma = np.sqrt(np.sum(weights*self.sigma_stats['sq_resid']) / self.delta1)
+
+
+    def add_training_rows(self, start, count):
+        '''
+        Insert the new training points into the design, moment features and KD-tree and update sigma 
+            (see update_sigma). tau is kept, also when it was selected by cross-validation. New 
+            temperatures above the current maximum change the normalization, then the design is 
+            prepared and sigma estimated from scratch. 
+
+        '''
+
+        new = slice(start, start + count)
+        Tn, O2n, yn = np.ravel(self.Temps)[new], np.ravel(self.O2convs)[new], np.ravel(self.dXdt)[new]
+
+        if np.amax(Tn) > self.T_SCALE:
+            self.prepare_design()
+            self.estimate_sigma(samples=self.sigma_samples)
+
+        else:
+            design = np.vstack([Tn / self.T_SCALE, O2n])
+            features, features_y = self.moment_features(design, yn)
+            self.design = np.ascontiguousarray(np.concatenate([self.design[:,:start], design, self.design[:,start:]], axis=1))
+            self.y = np.concatenate([self.y[:start], yn, self.y[start:]])
+            self.features = np.concatenate([self.features[:start], features, self.features[start:]])
+            self.features_y = np.concatenate([self.features_y[:start], features_y, self.features_y[start:]])
+            self.tree = cKDTree(self.design.T)
+            self.update_sigma(start, count)
+
+        super().add_training_rows(start, count)
+
+
+    def select_tau(self, taus = None, score = 'loo', n_threads = None, max_memory = None):
+        '''
+        Select the kernel bandwidth tau from a grid of candidates by leave-one-out ('loo') or 
+            generalized ('gcv') cross-validation of the unconstrained fit at the training points, 
+            using the full Gaussian kernel also when the model has a cutoff. 
+
+        Sets tau, tau_grid, tau_scores and tau_score (the criterion). Call estimate_sigma afterwards 
+            when changing tau of a fitted model. 
+
+        Inputs:
+            taus - candidate bandwidths, defaults to 16 values log-spaced from 0.02 to 0.5
+            score - 'loo' for leave-one-out or 'gcv' for generalized cross-validation
+            n_threads - number of candidates evaluated at once, defaults to n_threads of the model
+            max_memory - approximate peak memory in bytes, defaults to max_memory of the model
+
+        Returns:
+            tau - selected bandwidth (the candidate with the lowest score)
+
+        '''
+
+        if score not in ['loo', 'gcv']:
+            raise Exception('Invalid bandwidth selection score {} entered.'.format(score))
+
+        taus = np.geomspace(0.02, 0.5, 16) if taus is None else np.asarray(taus, dtype=float)
+        if n_threads is None:
+            n_threads = self.n_threads
+        if max_memory is None:
+            max_memory = self.max_memory
+
+        y = self.y
+        M = y.shape[0]
+        X = np.column_stack([self.design.T, np.ones(M)]) # M x 3
+        block = min(self.query_chunk_size(max_memory=max_memory, n_threads=n_threads), M)
+
+        # Per candidate sums of squared LOO residuals, squared residuals and L_ii
+        sums = np.zeros((taus.shape[0], 3))
+
+        def candidate_sums(tau, rows):
+            # In coordinates centred at each training point x_i = e, so L_ii = e^T A^-1 e and 
+            # yhat_i = e^T A^-1 b. Singular local fits use the pseudo-inverse. 
+            S, Sy, _ = self.kernel_moments(X[rows], tau, False)
+            A = S[:,self.SYM]
+            singular = ~(np.linalg.cond(A) < 1 / np.finfo(float).eps)
+            u = np.empty((A.shape[0], 3)) # A^-1 e
+            u[~singular] = np.linalg.solve(A[~singular], np.broadcast_to(np.array([0.0, 0.0, 1.0])[:,None], (np.sum(~singular), 3, 1)))[:,:,0]
+            u[singular] = np.linalg.pinv(A[singular], hermitian=True)[:,:,2]
+            resid = y[rows] - np.einsum('ni,ni->n', u, Sy)
+            Lii = u[:,2]
+            return np.array([np.sum((resid / (1 - Lii))**2), np.sum(resid**2), np.sum(Lii)])
+
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            for i in range(0, M, block):
+                rows = slice(i, i + block)
+                sums += np.array(list(executor.map(lambda tau: candidate_sums(tau, rows), taus)))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if score == 'loo':
+                scores = sums[:,0] / M
+            else:
+                scores = sums[:,1] / M / (1 - sums[:,2] / M)**2
+        scores[~np.isfinite(scores)] = np.inf
+
+        if not np.any(np.isfinite(scores)):
+            raise Exception('No finite {} score for the candidate bandwidths.'.format(score))
+
+        self.tau = taus[np.argmin(scores)]
+        self.tau_grid, self.tau_scores, self.tau_score = taus, scores, score
+
+        return self.tau
+
+
+    def query_chunk_size(self, chunk_size = None, max_memory = None, n_threads = 1):
+        '''
+        Number of query points to evaluate at once. An explicit chunk_size is used as is, otherwise 
+            it is derived from the memory budget max_memory (bytes), shared by n_threads concurrent 
+            chunks. Without either, all query points are evaluated at once. 
+
+        '''
+
+        if max_memory is None:
+            max_memory = self.max_memory
+
+        if chunk_size is not None:
+            return max(int(chunk_size), 1)
+        elif max_memory is None:
+            return np.iinfo(np.int64).max
+        
+        # Approximate bytes held for each query point: a few float64 temporaries of one block of 
+        # training points, for both the moment and the truncated kernel
+        bytes_per_query = 6*8*min(self.MOMENT_BLOCK, self.Temps.size) + 200
+
+        return max(int(max_memory // n_threads // bytes_per_query), 1)
+
+
+    def scalar_rate_and_var(self, T_norm, O2conv, tau, compute_var):
+        '''
+        Unconstrained rate and sum(L^2) for a single query from the prepared design, without 
+            building any per-call design arrays. The fit is solved in query-centred coordinates as 
+            in moment_rate_and_var. 
+
+        '''
+
+        x = np.empty((3, self.y.shape[0])) # rows d0, d1, 1
+        x[:2] = self.design - np.array([[T_norm], [O2conv]])
+        x[:2] *= 1 / tau
+        x[2] = 1.0
+        wx = np.exp(-0.5*np.einsum('im,im->m', x[:2], x[:2])) * x
+
+        u = np.linalg.solve(np.dot(wx, x.T), np.array([0.0, 0.0, 1.0])) # A^-1 e (A is symmetric)
+        dX = np.dot(u, np.dot(wx, self.y))
+
+        # The row of L is cheap to form for one query, and sum(L^2) from it avoids the cancellation 
+        # in e^T A^-1 B A^-1 e when A is badly conditioned
+        sumL2 = None
+        if compute_var:
+            L = np.dot(u, wx)
+            sumL2 = np.dot(L, L)
+
+        return dX, sumL2
+
+
+    def rate_jacobian(self, T, O2conv):
+        '''
+        Partial derivatives of the conversion rate with respect to temperature and conversion from the 
+            local linear fit at (T, O2conv). With coefficients beta = A^-1 b and u = A^-1 xq, the 
+            derivative along query coordinate k is the slope coefficient beta_k plus the effect of 
+            moving the kernel weights, 
+
+                u^T sum w*(x_k - xq_k)/tau^2 * x*(y - x^T beta)
+
+            Used as the Jacobian for implicit solvers. 
+
+        Returns:
+            dT - derivative of the rate with respect to temperature
+            dX - derivative of the rate with respect to conversion
+
+        '''
+
+        xq = np.array([T / self.T_SCALE, O2conv, 1.0])
+        dist = self.design - xq[:2,None]
+        w = np.exp(np.sum(dist**2, axis=0) * (-0.5 / self.tau**2))
+
+        A = np.dot(w, self.features)[self.SYM]
+        beta = np.linalg.solve(A, np.dot(w, self.features_y)) # [t, o, 1] coefficients
+
+        # Clamped rates do not change
+        if self.constrained and np.dot(beta, xq) < 0:
+            return 0.0, 0.0
+
+        x = np.vstack([self.design, np.ones(self.y.shape[0])]) # 3 x M
+        wr = w * (self.y - np.dot(beta, x)) / self.tau**2
+        u = np.linalg.solve(A, xq)
+        grad = beta[:2] + np.dot(np.dot(x * wr, dist.T).T, u)
+
+        return grad[0] / self.T_SCALE, grad[1]
+
+
+    def moment_rate_and_var(self, xq, tau, compute_var):
+        '''
+        Unconstrained rate, sum(L^2) and L_qq (see evaluate_kernel) for query points xq (N x 3 rows of 
+            [T_norm, O2conv, 1]) from the moments of the full kernel (see kernel_moments), without 
+            forming the N x M hat matrix L. Memory is O(N) for any number of training points M. 
+        '''
+
+        # In coordinates centred on the query and scaled by tau, x = ((T_norm - Tq)/tau, 
+        # (O2conv - O2q)/tau, 1), the rate is e^T A^-1 b, sum(L^2) = e^T A^-1 B A^-1 e and 
+        # L_qq = e^T A^-1 e with A = sum w*x*x^T, B = sum w^2*x*x^T, b = sum w*x*y and e = (0, 0, 1)
+        S, Sy, S2 = self.kernel_moments(xq, tau, compute_var)
+        return self.moment_solve(S, Sy, S2, compute_var)
+
+
+    def kernel_moments(self, xq, tau, compute_var, points = None):
+        '''
+        Query-centred moments S (N x 6, unique entries 1, d0, d1, d0^2, d0*d1, d1^2 of A), Sy (N x 3, 
+            b) and S2 (N x 6, unique entries of B, zero if compute_var is False) of query points xq 
+            over the training points, or over the training points selected by points (slice or index 
+            array). Moments over disjoint sets of training points add up. 
+        '''
+
+        N = xq.shape[0]
+        design, y = (self.design, self.y) if points is None else (self.design[:,points], self.y[points])
+
+        # einsum sums each row in a fixed order (unlike BLAS), so results do not depend on N
+        def rows(U, V):
+            return np.einsum('nm,nm->n', U, V)
+
+        S, Sy, S2 = np.zeros((N, 6)), np.zeros((N, 3)), np.zeros((N, 6))
+        for i in range(0, y.shape[0], self.MOMENT_BLOCK):
+            blk = slice(i, i + self.MOMENT_BLOCK)
+            d0 = design[0,blk] - xq[:,:1] # N x block
+            d0 /= tau
+            d1 = design[1,blk] - xq[:,1:2]
+            d1 /= tau
+            W = d0*d0
+            W += d1*d1
+            W *= -0.5
+            np.exp(W, out=W)
+            Wd0, Wd1 = W*d0, W*d1
+            S += np.column_stack([np.sum(W, axis=1), np.sum(Wd0, axis=1), np.sum(Wd1, axis=1), 
+                                  rows(Wd0, d0), rows(Wd0, d1), rows(Wd1, d1)])
+            Sy += np.column_stack([np.einsum('nm,m->n', Wd0, y[blk]), np.einsum('nm,m->n', Wd1, y[blk]), np.einsum('nm,m->n', W, y[blk])])
+            if compute_var:
+                S2 += np.column_stack([rows(W, W), rows(W, Wd0), rows(W, Wd1), 
+                                       rows(Wd0, Wd0), rows(Wd0, Wd1), rows(Wd1, Wd1)])
+
+        return S, Sy, S2
+
+
+    def moment_solve(self, S, Sy, S2, compute_var):
+        '''
+        Unconstrained rate, sum(L^2) and L_qq from query-centred moments, see moment_rate_and_var
+        '''
+
+        SYM = self.SYM
+        N = S.shape[0]
+        u = np.linalg.solve(S[:,SYM], np.broadcast_to(np.array([0.0, 0.0, 1.0])[:,None], (N, 3, 1)))[:,:,0] # A^-1 e
+        dX = np.einsum('ni,ni->n', u, Sy)
+
+        sumL2 = None
+        if compute_var:
+            sumL2 = np.einsum('ni,nij,nj->n', u, S2[:,SYM], u)
+
+        return dX, sumL2, u[:,2]
+
+
+    def truncated_rate_and_var(self, xq, tau, compute_var, return_moments = False):
+        '''
+        Unconstrained rate, sum(L^2) and L_qq (see evaluate_kernel) for query points xq (N x 3 rows of 
+            [T_norm, O2conv, 1]) using only training points near each query (see truncated_moments). 
+            Queries whose truncated fit is singular or may be off by more than TRUNC_TOL (see 
+            truncation_fallback) are evaluated with the full kernel instead. 
+
+        Returns:
+            dX, sumL2, Lqq - as for moment_rate_and_var
+            moments, fallback - only if return_moments is True, the moments each query was solved 
+                with (N x 15, see kernel_moments) and whether it used the full kernel
+
+        '''
+
+        S, Sy, S2 = self.truncated_moments(xq, tau, compute_var)
+        fallback = self.truncation_fallback(xq, tau, S, Sy)
+        if np.any(fallback):
+            S[fallback], Sy[fallback], S2[fallback] = self.kernel_moments(xq[fallback], tau, compute_var)
+        dX, sumL2, Lqq = self.moment_solve(S, Sy, S2, compute_var)
+
+        if return_moments:
+            return dX, sumL2, Lqq, np.column_stack([S, Sy, S2]), fallback
+
+        return dX, sumL2, Lqq
+
+
+    def truncated_moments(self, xq, tau, compute_var, points = None):
+        '''
+        Moments S, Sy and S2 (see kernel_moments) of query points xq over the training points near 
+            each query, or over those in the slice points. These include all training points within 
+            cutoff*tau. 
+        '''
+
+        N = xq.shape[0]
+        start, tree = (0, self.tree) if points is None else (points.start, cKDTree(self.design[:,points].T))
+
+        # Group queries by cells of size cutoff*tau/2. Each group is evaluated densely against the 
+        # training points within cutoff*tau of any point of its cell. 
+        h = self.cutoff*tau/2
+        cells, group = np.unique(np.floor(xq[:,:2] / h), axis=0, return_inverse=True)
+        order = np.argsort(group.ravel(), kind='stable')
+        bounds = np.searchsorted(group.ravel()[order], np.arange(cells.shape[0] + 1))
+
+        S, Sy, S2 = np.zeros((N, 6)), np.zeros((N, 3)), np.zeros((N, 6))
+        for g in range(cells.shape[0]):
+            queries = order[bounds[g]:bounds[g+1]]
+            near = np.sort(np.array(tree.query_ball_point((cells[g] + 0.5)*h, r=self.cutoff*tau + h/np.sqrt(2)), dtype=int))
+            S[queries], Sy[queries], S2[queries] = self.kernel_moments(xq[queries], tau, compute_var, points=start + near)
+
+        return S, Sy, S2
+
+
+    def truncation_fallback(self, xq, tau, S, Sy):
+        '''
+        Whether each query xq needs the full kernel because the local fit from its truncated moments 
+            S and Sy is singular or its truncation error (see truncation_error) may exceed TRUNC_TOL 
+            relative to the fit
+        '''
+
+        TRUNC_TOL = 1e-6
+
+        A = S[:,self.SYM]
+        fallback = ~(np.linalg.cond(A) < 1 / np.finfo(float).eps)
+        ok = ~fallback
+        u = np.linalg.solve(A[ok], np.broadcast_to(np.array([0.0, 0.0, 1.0])[:,None], (np.sum(ok), 3, 1)))[:,:,0] # A^-1 e
+        beta = np.linalg.solve(A[ok], Sy[ok,:,None])[:,:,0]
+        fallback[ok] = ~(self.truncation_error(xq[ok], tau, u, beta) <= TRUNC_TOL*np.linalg.norm(beta, axis=1))
+
+        return fallback
+
+
+    def truncation_error(self, xq, tau, u, beta):
+        '''
+        First order bound on the change of the rate e^T beta (u = A^-1 e) when the training points
+            beyond cutoff*tau of each query xq are added back
+        '''
+
+        # A point at distance s*tau changes each moment by at most f(s) = s^2*exp(-s^2/2) (times
+        # max|y| for b), which decreases for s >= sqrt(2). Dropped points are counted in shells of
+        # tau/2, points beyond the last shell count with its f
+        radii = self.cutoff + 0.5*np.arange(5)
+        f = radii**2 * np.exp(-radii**2 / 2)
+        inside = np.column_stack([self.tree.query_ball_point(xq[:,:2], r=r*tau, return_length=True) for r in radii] 
+                                 + [self.y.shape[0]*np.ones(xq.shape[0], dtype=int)])
+        dropped = np.dot(np.diff(inside, axis=1), f)
+
+        # |e^T A^-1 (db - dA beta)| with ||dA|| <= 3*dropped and ||db|| <= sqrt(3)*max|y|*dropped
+        return np.linalg.norm(u, axis=1) * dropped * (3*np.linalg.norm(beta, axis=1) + np.sqrt(3)*np.amax(np.abs(self.y)))
+
+
     def print_uncertainty_surf(self, save_path=None, vmin=None, vmax=None, legend=True):
         '''
         Plot surface of variances across the estimation